@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         LMArena API Bridge
 // @namespace    http://tampermonkey.net/
-// @version      2.5
+// @version      2.8
 // @description  Bridges LMArena to a local API server via WebSocket for streamlined automation.
 // @author       Lianues
 // @match        https://lmarena.ai/*
@@ -16,49 +16,84 @@
 
     // --- 配置 ---
     const SERVER_URL = "ws://127.0.0.1:5102/ws"; // 与 api_server.py 中的端口匹配
+    // 安静模式：设为 true 时不再输出每个请求的常规日志（包括完整的请求载荷，附带图片时可能有数 MB），
+    // 只保留连接状态、警告和错误。与服务器的 "production" 日志模式配合使用。
+    const QUIET_MODE = false;
+    // 数据块合并：每隔 N 毫秒或累计 M 字节（先到者为准）把所有待发数据块合并为一帧发送。
+    // 将 COALESCE_INTERVAL_MS 设为 0 可禁用合并，逐块发送。
+    const COALESCE_INTERVAL_MS = 25;
+    const COALESCE_MAX_BYTES = 16 * 1024;
+    // 二进制帧协议 (与 modules/bridge_protocol.py 保持一致)
+    // 帧格式: type(1 字节) + stream_id(4 字节) + length(4 字节) + UTF-8 payload，大端序
+    const PROTOCOL_VERSION = 2;
+    const FRAME_DATA = 1, FRAME_DONE = 2, FRAME_ERROR = 3, FRAME_COMMAND = 4, FRAME_ID_UPDATE = 5;
+    const FRAME_HEADER_SIZE = 9;
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
     let socket;
+    let useBinaryProtocol = false; // 服务器确认握手后才启用二进制帧
+    const streamIds = new Map(); // requestId -> stream_id
+    const requestIdsByStream = new Map(); // stream_id -> requestId
     let isCaptureModeActive = false; // ID捕获模式的开关
+    const pausedRequests = new Map(); // 被服务器要求暂停的请求: requestId -> { promise, resolve }
+    const pendingChunks = new Map(); // 等待合并发送的数据块: requestId -> string[]
+    const activeFetches = new Map(); // 进行中的请求: requestId -> AbortController，用于响应服务器的 cancel 指令
+    let pendingBytes = 0;
+    let flushTimer = null;
+
+    // 每个请求的常规日志，安静模式下不输出
+    function debugLog(...args) {
+        if (!QUIET_MODE) console.log(...args);
+    }
 
     // --- 核心逻辑 ---
     function connect() {
         console.log(`[API Bridge] 正在连接到本地服务器: ${SERVER_URL}...`);
         socket = new WebSocket(SERVER_URL);
+        socket.binaryType = 'arraybuffer';
 
         socket.onopen = () => {
             console.log("[API Bridge] ✅ 与本地服务器的 WebSocket 连接已建立。");
             document.title = "✅ " + document.title;
+            // 协议握手：旧版服务器会忽略此消息，此时继续使用 JSON 文本协议
+            useBinaryProtocol = false;
+            sendRaw({ type: 'hello', protocol: PROTOCOL_VERSION });
         };
 
         socket.onmessage = async (event) => {
             try {
+                if (typeof event.data !== 'string') {
+                    handleBinaryMessage(event.data);
+                    return;
+                }
+
                 const message = JSON.parse(event.data);
 
+                if (message.type === 'hello_ack') {
+                    useBinaryProtocol = message.protocol >= PROTOCOL_VERSION;
+                    console.log(`[API Bridge] 🔗 协议握手完成，使用${useBinaryProtocol ? '二进制帧' : ' JSON '}协议。`);
+                    return;
+                }
+
                 // 检查是否是指令，而不是标准的聊天请求
                 if (message.command) {
-                    console.log(`[API Bridge] ⬇️ 收到指令: ${message.command}`);
-                    if (message.command === 'refresh' || message.command === 'reconnect') {
-                        console.log(`[API Bridge] 收到 '${message.command}' 指令，正在执行页面刷新...`);
-                        location.reload();
-                    } else if (message.command === 'activate_id_capture') {
-                        console.log("[API Bridge] ✅ ID 捕获模式已激活。请在页面上触发一次 'Retry' 操作。");
-                        isCaptureModeActive = true;
-                        // 可以选择性地给用户一个视觉提示
-                        document.title = "🎯 " + document.title;
-                    } else if (message.command === 'send_page_source') {
-                        console.log("[API Bridge] 收到发送页面源码的指令，正在发送...");
-                        sendPageSource();
-                    }
+                    handleCommand(message.command, message.request_id);
                     return;
                 }
 
-                const { request_id, payload } = message;
+                const { request_id, payload, stream_id } = message;
 
                 if (!request_id || !payload) {
                     console.error("[API Bridge] 收到来自服务器的无效消息:", message);
                     return;
                 }
 
-                console.log(`[API Bridge] ⬇️ 收到聊天请求 ${request_id.substring(0, 8)}。准备执行 fetch 操作。`);
+                if (stream_id !== undefined) {
+                    streamIds.set(request_id, stream_id);
+                    requestIdsByStream.set(stream_id, request_id);
+                }
+
+                debugLog(`[API Bridge] ⬇️ 收到聊天请求 ${request_id.substring(0, 8)}。准备执行 fetch 操作。`);
                 await executeFetchAndStreamBack(request_id, payload);
 
             } catch (error) {
@@ -68,6 +103,14 @@
 
         socket.onclose = () => {
             console.warn("[API Bridge] 🔌 与本地服务器的连接已断开。将在5秒后尝试重新连接...");
+            useBinaryProtocol = false;
+            // 连接断开后服务器已放弃这些请求，中止进行中的 fetch 并释放所有暂停中的读取
+            for (const requestId of Array.from(activeFetches.keys())) {
+                cancelRequest(requestId);
+            }
+            for (const requestId of Array.from(pausedRequests.keys())) {
+                resumeRequest(requestId);
+            }
             if (document.title.startsWith("✅ ")) {
                 document.title = document.title.substring(2);
             }
@@ -80,8 +123,48 @@
         };
     }
 
+    function handleCommand(command, requestId) {
+        debugLog(`[API Bridge] ⬇️ 收到指令: ${command}`);
+        if (command === 'refresh' || command === 'reconnect') {
+            console.log(`[API Bridge] 收到 '${command}' 指令，正在执行页面刷新...`);
+            location.reload();
+        } else if (command === 'activate_id_capture') {
+            console.log("[API Bridge] ✅ ID 捕获模式已激活。请在页面上触发一次 'Retry' 操作。");
+            isCaptureModeActive = true;
+            // 可以选择性地给用户一个视觉提示
+            document.title = "🎯 " + document.title;
+        } else if (command === 'send_page_source') {
+            console.log("[API Bridge] 收到发送页面源码的指令，正在发送...");
+            sendPageSource();
+        } else if (command === 'pause') {
+            pauseRequest(requestId);
+        } else if (command === 'resume') {
+            resumeRequest(requestId);
+        } else if (command === 'cancel') {
+            cancelRequest(requestId);
+        }
+    }
+
+    function handleBinaryMessage(buffer) {
+        const view = new DataView(buffer);
+        let offset = 0;
+        while (offset + FRAME_HEADER_SIZE <= buffer.byteLength) {
+            const type = view.getUint8(offset);
+            const streamId = view.getUint32(offset + 1);
+            const length = view.getUint32(offset + 5);
+            const payload = textDecoder.decode(new Uint8Array(buffer, offset + FRAME_HEADER_SIZE, length));
+            offset += FRAME_HEADER_SIZE + length;
+
+            if (type === FRAME_COMMAND) {
+                handleCommand(payload, requestIdsByStream.get(streamId));
+            } else {
+                console.warn(`[API Bridge] 收到未知类型的二进制帧: ${type}`);
+            }
+        }
+    }
+
     async function executeFetchAndStreamBack(requestId, payload) {
-        console.log(`[API Bridge] 当前操作域名: ${window.location.hostname}`);
+        debugLog(`[API Bridge] 当前操作域名: ${window.location.hostname}`);
         const { is_image_request, message_templates, target_model_id, session_id, message_id } = payload;
 
         // --- 使用从后端配置传递的会话信息 ---
@@ -97,7 +180,7 @@
         const apiUrl = `/nextjs-api/stream/retry-evaluation-session-message/${session_id}/messages/${message_id}`;
         const httpMethod = 'PUT';
 
-        console.log(`[API Bridge] 使用 API 端点: ${apiUrl}`);
+        debugLog(`[API Bridge] 使用 API 端点: ${apiUrl}`);
 
         const newMessages = [];
         let lastMsgIdInChain = null;
@@ -143,12 +226,19 @@
             modelId: target_model_id,
         };
 
-        console.log("[API Bridge] 准备发送到 LMArena API 的最终载荷:", JSON.stringify(body, null, 2));
+        if (!QUIET_MODE) {
+            console.log("[API Bridge] 准备发送到 LMArena API 的最终载荷:", JSON.stringify(body, null, 2));
+        }
+
+        // API 客户端断开后服务器会发送 cancel 指令，通过 AbortController 中止 fetch 及后续读取
+        const abortController = new AbortController();
+        activeFetches.set(requestId, abortController);
 
         // 设置一个标志，让我们的 fetch 拦截器知道这个请求是脚本自己发起的
         window.isApiBridgeRequest = true;
         try {
             const response = await fetch(apiUrl, {
+                signal: abortController.signal,
                 method: httpMethod,
                 headers: {
                     'Content-Type': 'text/plain;charset=UTF-8', // LMArena 使用 text/plain
@@ -167,40 +257,180 @@
             const decoder = new TextDecoder();
 
             while (true) {
+                // 服务器端缓冲过多时会要求暂停，在恢复前不再读取响应
+                await waitIfPaused(requestId);
                 const { value, done } = await reader.read();
                 if (done) {
-                    console.log(`[API Bridge] ✅ 请求 ${requestId.substring(0, 8)} 的流已成功结束。`);
+                    debugLog(`[API Bridge] ✅ 请求 ${requestId.substring(0, 8)} 的流已成功结束。`);
                     // 仅在流成功结束后发送 [DONE]
                     sendToServer(requestId, "[DONE]");
                     break;
                 }
-                const chunk = decoder.decode(value);
-                // 直接将原始数据块转发回后端
-                sendToServer(requestId, chunk);
+                const chunk = decoder.decode(value, { stream: true });
+                // 将原始数据块（合并后）转发回后端
+                queueChunk(requestId, chunk);
             }
 
         } catch (error) {
-            console.error(`[API Bridge] ❌ 在为请求 ${requestId.substring(0, 8)} 执行 fetch 时出错:`, error);
-            // 发生错误时，只发送错误信息，不再发送 [DONE]
-            sendToServer(requestId, { error: error.message });
+            if (abortController.signal.aborted) {
+                // 服务器已放弃该请求，无需再回传任何内容
+                debugLog(`[API Bridge] ⏹️ 请求 ${requestId.substring(0, 8)} 已按服务器指令中止。`);
+            } else {
+                console.error(`[API Bridge] ❌ 在为请求 ${requestId.substring(0, 8)} 执行 fetch 时出错:`, error);
+                // 发生错误时，只发送错误信息，不再发送 [DONE]
+                sendToServer(requestId, { error: error.message });
+            }
         } finally {
             // 请求结束后，无论成功与否，都重置标志
             window.isApiBridgeRequest = false;
+            activeFetches.delete(requestId);
+            resumeRequest(requestId);
+            requestIdsByStream.delete(streamIds.get(requestId));
+            streamIds.delete(requestId);
         }
     }
 
+    // --- 流控 (背压) ---
+    function pauseRequest(requestId) {
+        if (!requestId || pausedRequests.has(requestId)) return;
+        let resolve;
+        const promise = new Promise(r => { resolve = r; });
+        pausedRequests.set(requestId, { promise, resolve });
+        debugLog(`[API Bridge] ⏸️ 请求 ${requestId.substring(0, 8)} 已暂停读取（服务器缓冲已满）。`);
+    }
+
+    function resumeRequest(requestId) {
+        const gate = pausedRequests.get(requestId);
+        if (!gate) return;
+        pausedRequests.delete(requestId);
+        gate.resolve();
+        debugLog(`[API Bridge] ▶️ 请求 ${requestId.substring(0, 8)} 已恢复读取。`);
+    }
+
+    function cancelRequest(requestId) {
+        const controller = activeFetches.get(requestId);
+        if (!controller) return;
+        // 丢弃尚未发出的数据块，并解除暂停，让读取循环立即因中止而退出
+        const chunks = pendingChunks.get(requestId);
+        if (chunks) {
+            pendingBytes -= chunks.reduce((n, c) => n + c.length, 0);
+            pendingChunks.delete(requestId);
+        }
+        controller.abort();
+        resumeRequest(requestId);
+    }
+
+    async function waitIfPaused(requestId) {
+        const gate = pausedRequests.get(requestId);
+        if (gate) await gate.promise;
+    }
+
     function sendToServer(requestId, data) {
+        // 先发出所有已合并的数据块，保证 [DONE] / 错误总在数据之后到达
+        flushChunks();
+        const frame = toFrame(requestId, data);
+        if (frame) {
+            sendFrames([frame]);
+        } else {
+            sendRaw({ request_id: requestId, data: data });
+        }
+    }
+
+    function sendRaw(message) {
         if (socket && socket.readyState === WebSocket.OPEN) {
-            const message = {
-                request_id: requestId,
-                data: data
-            };
             socket.send(JSON.stringify(message));
         } else {
             console.error("[API Bridge] 无法发送数据，WebSocket 连接未打开。");
         }
     }
 
+    // --- 二进制帧协议 ---
+    // 协议已启用且请求有 stream_id 时返回对应的帧，否则返回 null（调用方回退到 JSON）
+    function toFrame(requestId, data) {
+        const streamId = streamIds.get(requestId);
+        if (!useBinaryProtocol || streamId === undefined) return null;
+        if (data === "[DONE]") return { type: FRAME_DONE, streamId, payload: '' };
+        if (data && typeof data === 'object' && 'error' in data) {
+            return { type: FRAME_ERROR, streamId, payload: String(data.error) };
+        }
+        return { type: FRAME_DATA, streamId, payload: data };
+    }
+
+    function sendFrames(frames) {
+        const encoded = frames.map(f => ({ type: f.type, streamId: f.streamId, bytes: textEncoder.encode(f.payload) }));
+        const total = encoded.reduce((n, f) => n + FRAME_HEADER_SIZE + f.bytes.length, 0);
+        const buffer = new Uint8Array(total);
+        const view = new DataView(buffer.buffer);
+        let offset = 0;
+        for (const f of encoded) {
+            view.setUint8(offset, f.type);
+            view.setUint32(offset + 1, f.streamId);
+            view.setUint32(offset + 5, f.bytes.length);
+            buffer.set(f.bytes, offset + FRAME_HEADER_SIZE);
+            offset += FRAME_HEADER_SIZE + f.bytes.length;
+        }
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(buffer);
+        } else {
+            console.error("[API Bridge] 无法发送数据，WebSocket 连接未打开。");
+        }
+    }
+
+    // --- 数据块合并 ---
+    function queueChunk(requestId, chunk) {
+        if (!chunk) return;
+        if (COALESCE_INTERVAL_MS <= 0) {
+            const frame = toFrame(requestId, chunk);
+            if (frame) {
+                sendFrames([frame]);
+            } else {
+                sendRaw({ request_id: requestId, data: chunk });
+            }
+            return;
+        }
+        if (!pendingChunks.has(requestId)) {
+            pendingChunks.set(requestId, []);
+        }
+        pendingChunks.get(requestId).push(chunk);
+        pendingBytes += chunk.length;
+
+        if (pendingBytes >= COALESCE_MAX_BYTES) {
+            flushChunks();
+        } else if (flushTimer === null) {
+            flushTimer = setTimeout(flushChunks, COALESCE_INTERVAL_MS);
+        }
+    }
+
+    function flushChunks() {
+        if (flushTimer !== null) {
+            clearTimeout(flushTimer);
+            flushTimer = null;
+        }
+        if (pendingChunks.size === 0) return;
+
+        const frames = [];
+        const entries = [];
+        for (const [requestId, chunks] of pendingChunks) {
+            const data = chunks.join('');
+            const frame = toFrame(requestId, data);
+            if (frame) {
+                frames.push(frame);
+            } else {
+                entries.push({ request_id: requestId, data: data });
+            }
+        }
+        pendingChunks.clear();
+        pendingBytes = 0;
+
+        // 二进制协议下所有帧拼接为一条消息；JSON 协议下只有一个请求时使用普通消息格式，多个请求时使用合并帧
+        if (frames.length > 0) {
+            sendFrames(frames);
+        }
+        if (entries.length > 0) {
+            sendRaw(entries.length === 1 ? entries[0] : { batch: entries });
+        }
+    }
+
     // --- 网络请求拦截 ---
     const originalFetch = window.fetch;
     window.fetch = function (...args) {
@@ -273,7 +503,7 @@
 
     // --- 启动连接 ---
     console.log("========================================");
-    console.log("  LMArena API Bridge v2.5 正在运行。");
+    console.log("  LMArena API Bridge v2.8 正在运行。");
     console.log("  - 聊天功能已连接到 ws://127.0.0.1:5102");
     console.log("  - ID 捕获器将发送到 http://127.0.0.1:5103");
     console.log("========================================");
@@ -6,26 +6,35 @@ import json
 import logging
 import os
 import sys
-import subprocess
 import time
 import uuid
 import re
-import threading
-import random
 import mimetypes
-from datetime import datetime
 from contextlib import asynccontextmanager
 
 import uvicorn
-import requests
-from packaging.version import parse as parse_version
 from typing import Optional
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse, Response
 
 # --- 内部模块导入 ---
-from modules.file_uploader import upload_to_file_bed
+# requests、packaging 以及 file_uploader (httpx) 只在更新检查、文件床上传等
+# 非热路径上使用，改为在使用处导入，以缩短每次（重）启动的导入耗时。
+from modules.attachment_cache import AttachmentCache, content_key
+from modules.browser_pool import BrowserWorkerPool
+from modules.admission import AdmissionController, AdmissionRejected
+from modules.session_pool import SessionPool, prefix_fingerprints
+from modules.model_extractor import extract_models_from_html
+from modules.persistence import PersistenceService, atomic_write
+from modules.idle_timer import IdleTimer
+from modules import log_setup
+from modules.log_setup import request_logger
+from modules.stream_parser import LMArenaStreamParser, CLOUDFLARE_MARKERS
+from modules.response_channel import ResponseChannel, DEFAULT_HIGH_WATER_BYTES, SERVER_ABORT_OUTCOMES
+from modules import bridge_protocol as bp
+from modules import json_codec
+from modules.metrics import MetricsRegistry
 
 
 # --- 基础配置 ---
@@ -33,20 +42,97 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- 全局状态与配置 ---
-CONFIG = {} # 存储从 config.jsonc 加载的配置
-# browser_ws 用于存储与单个油猴脚本的 WebSocket 连接。
-# 注意：此架构假定只有一个浏览器标签页在工作。
-# 如果需要支持多个并发标签页，需要将此扩展为字典管理多个连接。
-browser_ws: Optional[WebSocket] = None
-# response_channels 用于存储每个 API 请求的响应队列。
-# 键是 request_id，值是 asyncio.Queue。
-response_channels: dict[str, asyncio.Queue] = {}
-last_activity_time = None # 记录最后一次活动的时间
-idle_monitor_thread = None # 空闲监控线程
+# 存储从 config.jsonc 加载的配置快照。
+# 快照在加载后不再被原地修改：重新加载或更新时总是构建新字典并整体替换引用，
+# 因此请求在入口处取得的引用在整个请求期间保持一致。
+CONFIG = {}
+# browser_pool 管理所有已连接的油猴脚本标签页（Worker）。
+# 每个标签页独立注册，请求按最少在途请求数分派到健康的标签页。
+browser_pool = BrowserWorkerPool()
+# admission 在分派前执行准入控制：限制每个标签页/会话的并发数，超出部分排队或返回 429。
+admission = AdmissionController(browser_pool)
+# session_pool 在模型映射到多个会话 ID 时按健康状况和负载选择会话，并暂时剔除连续失败的会话；
+# 同一多轮对话的后续请求优先回到上次服务它的会话。
+session_pool = SessionPool()
+# attachment_cache 以附件内容的 SHA-256 缓存文件床上传结果，重复发送的历史图片不再重复上传。
+attachment_cache = AttachmentCache()
+# persistence 在后台线程中防抖、原子地写回 config.jsonc 和 available_models.json，
+# 避免在事件循环上做同步文件 I/O；短时间内的多次 id_update 只会产生一次写入。
+persistence = PersistenceService()
+# response_channels 用于存储每个 API 请求的响应通道。
+# 键是 request_id，值是带高/低水位流控的 ResponseChannel。
+response_channels: dict[str, ResponseChannel] = {}
+idle_timer = IdleTimer() # 空闲检测（事件循环定时器），活动时间与进行中的响应流数由它记录
 main_event_loop = None # 主事件循环
 # 新增：用于跟踪是否因人机验证而刷新
 IS_REFRESHING_FOR_VERIFICATION = False
 
+# --- 指标 (Prometheus 文本格式，由 /metrics 导出) ---
+metrics = MetricsRegistry()
+REQUESTS_TOTAL = metrics.counter(
+    "lmarena_bridge_requests_total", "按模型和结果统计的聊天请求数。", ("model", "outcome"))
+TTFT_SECONDS = metrics.histogram(
+    "lmarena_bridge_time_to_first_token_seconds", "从收到 API 请求到产出第一个内容块的耗时。", ("model",))
+INTER_TOKEN_SECONDS = metrics.histogram(
+    "lmarena_bridge_inter_token_seconds", "相邻两个内容块之间的间隔。", ("model",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+STREAM_DURATION_SECONDS = metrics.histogram(
+    "lmarena_bridge_stream_duration_seconds", "从收到 API 请求到响应流结束的总耗时。", ("model", "outcome"))
+CLOUDFLARE_EVENTS_TOTAL = metrics.counter(
+    "lmarena_bridge_cloudflare_challenges_total", "检测到 Cloudflare 人机验证的次数。")
+FILE_BED_UPLOAD_SECONDS = metrics.histogram(
+    "lmarena_bridge_file_bed_upload_seconds", "单个附件上传到文件床的耗时。", ("outcome",))
+
+
+def _websocket_traffic(kind: str) -> dict:
+    totals = browser_pool.traffic_totals()
+    return {("sent",): totals[f"{kind}_sent"], ("received",): totals[f"{kind}_received"]}
+
+
+metrics.counter(
+    "lmarena_bridge_websocket_frames_total", "与油猴脚本之间的 WebSocket 消息数。", ("direction",),
+    function=lambda: _websocket_traffic("frames"))
+metrics.counter(
+    "lmarena_bridge_websocket_bytes_total", "与油猴脚本之间的 WebSocket 字节数。", ("direction",),
+    function=lambda: _websocket_traffic("bytes"))
+metrics.gauge(
+    "lmarena_bridge_active_channels", "当前在途的响应通道数。", function=lambda: len(response_channels))
+metrics.gauge(
+    "lmarena_bridge_buffered_bytes", "所有响应通道当前缓冲的数据量。",
+    function=lambda: sum(c.buffered_bytes for c in list(response_channels.values())))
+metrics.gauge(
+    "lmarena_bridge_browser_workers", "已连接的浏览器标签页数。", ("state",),
+    function=lambda: {("healthy",): len(browser_pool.healthy_workers()), ("total",): len(browser_pool)})
+metrics.counter(
+    "lmarena_bridge_attachment_cache_lookups_total", "文件床上传缓存的查询结果。", ("result",),
+    function=lambda: {("hit",): attachment_cache.hits, ("miss",): attachment_cache.misses})
+metrics.gauge(
+    "lmarena_bridge_ejected_sessions", "因连续失败而被暂时剔除的会话数。", function=lambda: session_pool.ejected_count())
+metrics.counter(
+    "lmarena_bridge_session_affinity_lookups_total", "多轮对话查找亲和会话的结果。", ("result",),
+    function=lambda: {("hit",): session_pool.affinity_hits, ("miss",): session_pool.affinity_misses})
+metrics.gauge(
+    "lmarena_bridge_admission_queue_depth", "准入控制队列中等待的请求数。", function=lambda: admission.queue_depth)
+metrics.counter(
+    "lmarena_bridge_admission_requests_total", "准入控制结果统计。", ("result",),
+    function=lambda: {("admitted",): admission.admitted_total, ("queued",): admission.queued_total,
+                      ("rejected",): admission.rejected_total, ("timed_out",): admission.timed_out_total})
+metrics.counter(
+    "lmarena_bridge_admission_wait_seconds_total", "排队后被准入的请求的累计等待时间。",
+    function=lambda: admission.wait_seconds_sum)
+metrics.counter(
+    "lmarena_bridge_admission_waited_requests_total", "排队后被准入的请求数。",
+    function=lambda: admission.waited_total)
+
+
+metrics.counter(
+    "lmarena_bridge_recycles_total", "进程内软重启的次数。", function=lambda: recycles_total)
+
+
+def _model_label(model_name: Optional[str]) -> str:
+    """只有 models.json 中的模型名才作为标签值，避免任意客户端输入导致标签基数失控。"""
+    return model_name if model_name in MODEL_NAME_TO_ID_MAP else "other"
+
 
 # --- 模型映射 ---
 # MODEL_NAME_TO_ID_MAP 现在将存储更丰富的对象： { "model_name": {"id": "...", "type": "..."} }
@@ -54,8 +140,12 @@ MODEL_NAME_TO_ID_MAP = {}
 MODEL_ENDPOINT_MAP = {} # 新增：用于存储模型到 session/message ID 的映射
 DEFAULT_MODEL_ID = None # 默认模型id: None
 
-def load_model_endpoint_map():
-    """从 model_endpoint_map.json 加载模型到端点的映射。"""
+def load_model_endpoint_map(keep_on_error: bool = False) -> bool:
+    """
+    从 model_endpoint_map.json 加载模型到端点的映射。
+    :param keep_on_error: 为 True 时（热重载），解析失败会保留当前映射而不是清空。
+    :return: 是否加载成功。
+    """
     global MODEL_ENDPOINT_MAP
     try:
         with open('model_endpoint_map.json', 'r', encoding='utf-8') as f:
@@ -66,12 +156,18 @@ def load_model_endpoint_map():
             else:
                 MODEL_ENDPOINT_MAP = json.loads(content)
         logger.info(f"成功从 'model_endpoint_map.json' 加载了 {len(MODEL_ENDPOINT_MAP)} 个模型端点映射。")
+        return True
     except FileNotFoundError:
         logger.warning("'model_endpoint_map.json' 文件未找到。将使用空映射。")
         MODEL_ENDPOINT_MAP = {}
+        return True
     except json.JSONDecodeError as e:
+        if keep_on_error:
+            logger.error(f"解析 'model_endpoint_map.json' 失败: {e}。将继续使用当前映射。")
+            return False
         logger.error(f"加载或解析 'model_endpoint_map.json' 失败: {e}。将使用空映射。")
         MODEL_ENDPOINT_MAP = {}
+        return False
 
 def _parse_jsonc(jsonc_string: str) -> dict:
     """
@@ -105,8 +201,12 @@ def _parse_jsonc(jsonc_string: str) -> dict:
 
     return json.loads("\n".join(no_comments_lines))
 
-def load_config():
-    """从 config.jsonc 加载配置，并处理 JSONC 注释。"""
+def load_config(keep_on_error: bool = False) -> bool:
+    """
+    从 config.jsonc 加载配置，并处理 JSONC 注释。
+    :param keep_on_error: 为 True 时（热重载），解析失败会保留当前配置快照而不是回退到默认配置。
+    :return: 是否加载成功。
+    """
     global CONFIG
     try:
         with open('config.jsonc', 'r', encoding='utf-8') as f:
@@ -116,12 +216,22 @@ def load_config():
         # 打印关键配置状态
         logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if CONFIG.get('tavern_mode_enabled') else '❌ 禁用'}")
         logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if CONFIG.get('bypass_enabled') else '❌ 禁用'}")
+        idle_timer.configure(CONFIG.get("enable_idle_restart", False), CONFIG.get("idle_restart_timeout_seconds", 300))
+        return True
     except (FileNotFoundError, json.JSONDecodeError) as e:
+        if keep_on_error:
+            logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将继续使用当前配置。")
+            return False
         logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将使用默认配置。")
         CONFIG = {}
+        return False
 
-def load_model_map():
-    """从 models.json 加载模型映射，支持 'id:type' 格式。"""
+def load_model_map(keep_on_error: bool = False) -> bool:
+    """
+    从 models.json 加载模型映射，支持 'id:type' 格式。
+    :param keep_on_error: 为 True 时（热重载），解析失败会保留当前模型列表而不是清空。
+    :return: 是否加载成功。
+    """
     global MODEL_NAME_TO_ID_MAP
     try:
         with open('models.json', 'r', encoding='utf-8') as f:
@@ -140,10 +250,60 @@ def load_model_map():
 
         MODEL_NAME_TO_ID_MAP = processed_map
         logger.info(f"成功从 'models.json' 加载并解析了 {len(MODEL_NAME_TO_ID_MAP)} 个模型。")
+        return True
 
     except (FileNotFoundError, json.JSONDecodeError) as e:
+        if keep_on_error:
+            logger.error(f"加载 'models.json' 失败: {e}。将继续使用当前模型列表。")
+            return False
         logger.error(f"加载 'models.json' 失败: {e}。将使用空模型列表。")
         MODEL_NAME_TO_ID_MAP = {}
+        return False
+
+# --- 配置热重载 ---
+# 被监视的文件及其加载函数。后台任务按 mtime 轮询，只有文件变化时才重新加载，
+# 请求路径上不再有任何文件读取或 JSONC 解析。
+WATCHED_CONFIG_FILES = {
+    'config.jsonc': load_config,
+    'models.json': load_model_map,
+    'model_endpoint_map.json': load_model_endpoint_map,
+}
+_watched_mtimes: dict[str, Optional[int]] = {}
+config_watcher_task = None
+
+def _file_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def record_config_mtimes():
+    """记录被监视文件的当前 mtime，作为后续变更检测的基准。"""
+    for path in WATCHED_CONFIG_FILES:
+        _watched_mtimes[path] = _file_mtime(path)
+
+def reload_changed_config_files() -> list[str]:
+    """重新加载自上次检查以来发生变化的文件，返回已重新加载的文件列表。"""
+    reloaded = []
+    for path, loader in WATCHED_CONFIG_FILES.items():
+        mtime = _file_mtime(path)
+        if mtime == _watched_mtimes.get(path):
+            continue
+        logger.info(f"检测到 '{path}' 已变更，正在热重载...")
+        # 解析失败（例如文件正被写入一半）时不记录 mtime，下一轮会重试
+        if loader(keep_on_error=True):
+            _watched_mtimes[path] = mtime
+            reloaded.append(path)
+    return reloaded
+
+async def config_watcher():
+    """后台任务：轮询配置文件的 mtime，变化时重新加载并原子替换快照。"""
+    while True:
+        await asyncio.sleep(CONFIG.get("config_reload_interval_seconds", 2))
+        try:
+            reload_changed_config_files()
+        except Exception as e:
+            logger.error(f"热重载配置时发生未知错误: {e}", exc_info=True)
 
 # --- 公告处理 ---
 def check_and_display_announcement():
@@ -179,6 +339,10 @@ GITHUB_REPO = "Lianues/LMArenaBridge"
 
 def download_and_extract_update(version):
     """下载并解压最新版本到临时文件夹。"""
+    import io
+    import zipfile
+    import requests
+
     update_dir = "update_temp"
     if not os.path.exists(update_dir):
         os.makedirs(update_dir)
@@ -189,9 +353,6 @@ def download_and_extract_update(version):
         response = requests.get(zip_url, timeout=60)
         response.raise_for_status()
 
-        # 需要导入 zipfile 和 io
-        import zipfile
-        import io
         with zipfile.ZipFile(io.BytesIO(response.content)) as z:
             z.extractall(update_dir)
         
@@ -206,14 +367,40 @@ def download_and_extract_update(version):
     
     return False
 
-def check_for_updates():
-    """从 GitHub 检查新版本。"""
-    if not CONFIG.get("enable_auto_update", True):
-        logger.info("自动更新已禁用，跳过检查。")
-        return
+# 最近一次更新检查的结果；检查在后台任务中进行，结果也写入磁盘，
+# 以便频繁重启时在 update_check_interval_seconds 内直接复用，不再访问 GitHub
+UPDATE_CHECK_CACHE_FILE = "update_check_cache.json"
+update_status = {"state": "pending"}
+update_check_task = None
+
+def _load_update_check_cache(current_version: str) -> Optional[dict]:
+    """读取未过期、且针对当前版本的检查结果。"""
+    try:
+        with open(UPDATE_CHECK_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    interval = CONFIG.get("update_check_interval_seconds", 3600)
+    if cached.get("current_version") != current_version or time.time() - cached.get("checked_at", 0) > interval:
+        return None
+    return cached
+
+def check_for_updates() -> dict:
+    """
+    从 GitHub 检查新版本（阻塞操作，需在工作线程中调用）。
+    返回检查结果；发现新版本时会下载并解压，由调用方决定何时应用。
+    """
+    import requests
+    from packaging.version import parse as parse_version
 
     current_version = CONFIG.get("version", "0.0.0")
+    cached = _load_update_check_cache(current_version)
+    if cached and not cached.get("update_available"):
+        logger.info(f"当前版本: {current_version}。{int(time.time() - cached['checked_at'])} 秒前已检查过，程序已是最新版本。")
+        return cached
+
     logger.info(f"当前版本: {current_version}。正在从 GitHub 检查更新...")
+    result = {"current_version": current_version, "checked_at": time.time(), "update_available": False}
 
     try:
         config_url = f"https://raw.githubusercontent.com/{GITHUB_REPO}/main/config.jsonc"
@@ -226,123 +413,166 @@ def check_for_updates():
         remote_version_str = remote_config.get("version")
         if not remote_version_str:
             logger.warning("远程配置文件中未找到版本号，跳过更新检查。")
-            return
+            result["state"] = "error"
+            result["error"] = "remote version missing"
+            return result
 
+        result["latest_version"] = remote_version_str
         if parse_version(remote_version_str) > parse_version(current_version):
+            result["update_available"] = True
             logger.info("="*60)
             logger.info(f"🎉 发现新版本! 🎉")
             logger.info(f"  - 当前版本: {current_version}")
             logger.info(f"  - 最新版本: {remote_version_str}")
             if download_and_extract_update(remote_version_str):
-                logger.info("准备应用更新。服务器将在5秒后关闭并启动更新脚本。")
-                time.sleep(5)
-                update_script_path = os.path.join("modules", "update_script.py")
-                # 使用 Popen 启动独立进程
-                subprocess.Popen([sys.executable, update_script_path])
-                # 优雅地退出当前服务器进程
-                os._exit(0)
+                result["state"] = "downloaded"
             else:
+                result["state"] = "download_failed"
                 logger.error(f"自动更新失败。请访问 https://github.com/{GITHUB_REPO}/releases/latest 手动下载。")
             logger.info("="*60)
         else:
+            result["state"] = "up_to_date"
             logger.info("您的程序已是最新版本。")
 
     except requests.RequestException as e:
         logger.error(f"检查更新失败: {e}")
+        result["state"] = "error"
+        result["error"] = str(e)
+        return result
     except json.JSONDecodeError:
         logger.error("解析远程配置文件失败。")
+        result["state"] = "error"
+        result["error"] = "invalid remote config"
+        return result
     except Exception as e:
         logger.error(f"检查更新时发生未知错误: {e}")
+        result["state"] = "error"
+        result["error"] = str(e)
+        return result
 
-# --- 模型更新 ---
-def extract_models_from_html(html_content):
-    """
-    从 HTML 内容中提取完整的模型JSON对象，使用括号匹配确保完整性。
-    """
-    models = []
-    model_names = set()
-    
-    # 查找所有可能的模型JSON对象的起始位置
-    for start_match in re.finditer(r'\{\\"id\\":\\"[a-f0-9-]+\\"', html_content):
-        start_index = start_match.start()
-        
-        # 从起始位置开始，进行花括号匹配
-        open_braces = 0
-        end_index = -1
-        
-        # 优化：设置一个合理的搜索上限，避免无限循环
-        search_limit = start_index + 10000 # 假设一个模型定义不会超过10000个字符
-        
-        for i in range(start_index, min(len(html_content), search_limit)):
-            if html_content[i] == '{':
-                open_braces += 1
-            elif html_content[i] == '}':
-                open_braces -= 1
-                if open_braces == 0:
-                    end_index = i + 1
-                    break
-        
-        if end_index != -1:
-            # 提取完整的、转义的JSON字符串
-            json_string_escaped = html_content[start_index:end_index]
-            
-            # 反转义
-            json_string = json_string_escaped.replace('\\"', '"').replace('\\\\', '\\')
-            
-            try:
-                model_data = json.loads(json_string)
-                model_name = model_data.get('publicName')
-                
-                # 使用publicName去重
-                if model_name and model_name not in model_names:
-                    models.append(model_data)
-                    model_names.add(model_name)
-            except json.JSONDecodeError as e:
-                logger.warning(f"解析提取的JSON对象时出错: {e} - 内容: {json_string[:150]}...")
-                continue
+    try:
+        atomic_write(UPDATE_CHECK_CACHE_FILE, json.dumps(result, ensure_ascii=False))
+    except OSError as e:
+        logger.warning(f"写入更新检查缓存失败: {e}")
+    return result
+
+async def run_update_check():
+    """后台任务：不阻塞启动，检查完成后更新 update_status；已下载新版本时在此应用更新。"""
+    global update_status
+    if not CONFIG.get("enable_auto_update", True):
+        logger.info("自动更新已禁用，跳过检查。")
+        update_status = {"state": "disabled"}
+        return
 
-    if models:
-        logger.info(f"成功提取并解析了 {len(models)} 个独立模型。")
-        return models
-    else:
-        logger.error("错误：在HTML响应中找不到任何匹配的完整模型JSON对象。")
-        return None
+    update_status = {"state": "checking"}
+    update_status = await asyncio.to_thread(check_for_updates)
+    if update_status.get("state") == "downloaded":
+        # 服务器此时已在处理请求：先暂停接收新请求并排空在途请求，再退出进程
+        logger.info("准备应用更新。服务器将在在途请求结束后关闭并启动更新脚本。")
+        await recycle_gate.wait() # 等待进行中的软重启完成
+        recycle_gate.clear()
+        await drain_in_flight_requests("应用更新")
+        await asyncio.sleep(1) # 让被中止请求的错误消息有时间发出
+        await persistence.flush() # 更新脚本启动前写入防抖中的配置/模型文件
+        import subprocess
+        update_script_path = os.path.join("modules", "update_script.py")
+        try:
+            # 使用 Popen 启动独立进程
+            subprocess.Popen([sys.executable, update_script_path])
+        except OSError as e:
+            logger.error(f"启动更新脚本失败: {e}。服务器将继续运行，请手动更新。")
+            update_status = {**update_status, "state": "apply_failed", "error": str(e)}
+            recycle_gate.set()
+            return
+        # 退出当前服务器进程（os._exit 不会执行 lifespan 的清理，先写出队列中的日志）
+        log_setup.shutdown_logging()
+        os._exit(0)
 
+# --- 模型更新 ---
 def save_available_models(new_models_list, models_path="available_models.json"):
     """
     将提取到的完整模型对象列表保存到指定的JSON文件中。
+    序列化和写盘由 persistence 在后台线程中完成。
     """
     logger.info(f"检测到 {len(new_models_list)} 个模型，正在更新 '{models_path}'...")
-    
-    try:
-        with open(models_path, 'w', encoding='utf-8') as f:
-            # 直接将完整的模型对象列表写入文件
-            json.dump(new_models_list, f, indent=4, ensure_ascii=False)
-        logger.info(f"✅ '{models_path}' 已成功更新，包含 {len(new_models_list)} 个模型。")
-    except IOError as e:
-        logger.error(f"❌ 写入 '{models_path}' 文件时出错: {e}")
+
+    # 直接将完整的模型对象列表写入文件
+    persistence.schedule(models_path, lambda: json.dumps(new_models_list, indent=4, ensure_ascii=False))
 
 # --- 自动重启逻辑 ---
+# 软重启期间清除此事件，新请求在入口处等待，直到状态重置完成
+recycle_gate = None
+recycles_total = 0
+
+async def notify_browser_reconnect():
+    """通知所有浏览器标签页刷新并重新连接。"""
+    for worker in list(browser_pool.workers.values()):
+        try:
+            # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
+            await worker.send_command("reconnect")
+            logger.info(f"已向浏览器 Worker [{worker.worker_id}] 发送 'reconnect' 指令。")
+        except Exception as e:
+            logger.error(f"向浏览器 Worker [{worker.worker_id}] 发送 'reconnect' 指令失败: {e}")
+
+async def drain_in_flight_requests(label: str):
+    """
+    等待在途请求结束，最多 recycle_drain_timeout_seconds 秒；超时后仍未结束的请求以错误结束。
+    调用方需先清除 recycle_gate，使新请求在入口处等待。
+    """
+    deadline = time.monotonic() + CONFIG.get("recycle_drain_timeout_seconds", 30)
+    while response_channels and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if response_channels:
+        logger.warning(f"{label}：{len(response_channels)} 个请求未能在排空时间内结束，已中止。")
+    for request_id in list(response_channels):
+        channel = response_channels.pop(request_id, None)
+        if channel:
+            channel.fail("Server is restarting, please retry.", "draining")
+
+async def soft_recycle(reason: str) -> bool:
+    """
+    进程内软重启：暂停接收新请求，排空在途请求，重置内部状态并重新加载配置文件，
+    最后通知浏览器标签页重新连接。不重启进程，服务端的中断时间只有排空所需的时间。
+    已有软重启在进行时返回 False。
+    """
+    global IS_REFRESHING_FOR_VERIFICATION, recycles_total
+    if not recycle_gate.is_set():
+        return False
+    recycle_gate.clear()
+    started_at = time.monotonic()
+    logger.warning("="*60)
+    logger.warning(f"{reason}，开始进程内软重启...")
+    try:
+        # 1. 等待在途请求结束（超时后仍未结束的请求以错误结束）
+        await drain_in_flight_requests("软重启")
+
+        # 2. 重置内部状态，并重新加载配置快照与模型映射
+        IS_REFRESHING_FOR_VERIFICATION = False
+        load_config(keep_on_error=True)
+        load_model_map(keep_on_error=True)
+        load_model_endpoint_map(keep_on_error=True)
+        record_config_mtimes()
+
+        # 3. 让浏览器标签页刷新并重新连接
+        await notify_browser_reconnect()
+        idle_timer.touch()
+        recycles_total += 1
+    finally:
+        recycle_gate.set()
+    logger.warning(f"软重启完成，耗时 {(time.monotonic() - started_at) * 1000:.0f} ms。")
+    logger.warning("="*60)
+    return True
+
 def restart_server():
-    """优雅地通知客户端刷新，然后重启服务器。"""
+    """优雅地通知客户端刷新，然后重启服务器进程。"""
     logger.warning("="*60)
     logger.warning("检测到服务器空闲超时，准备自动重启...")
     logger.warning("="*60)
     
-    # 1. (异步) 通知浏览器刷新
-    async def notify_browser_refresh():
-        if browser_ws:
-            try:
-                # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("已向浏览器发送 'reconnect' 指令。")
-            except Exception as e:
-                logger.error(f"发送 'reconnect' 指令失败: {e}")
-    
-    # 在主事件循环中运行异步通知函数
+    # 1. 在主事件循环中通知所有浏览器标签页刷新
     # 使用`asyncio.run_coroutine_threadsafe`确保线程安全
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
-        asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
+    if browser_pool.workers and main_event_loop:
+        asyncio.run_coroutine_threadsafe(notify_browser_reconnect(), main_event_loop)
     
     # 2. 延迟几秒以确保消息发送
     time.sleep(3)
@@ -351,42 +581,25 @@ def restart_server():
     logger.info("正在重启服务器...")
     os.execv(sys.executable, ['python'] + sys.argv)
 
-def idle_monitor():
-    """在后台线程中运行，监控服务器是否空闲。"""
-    global last_activity_time
-    
-    # 等待，直到 last_activity_time 被首次设置
-    while last_activity_time is None:
-        time.sleep(1)
-        
-    logger.info("空闲监控线程已启动。")
-    
-    while True:
-        if CONFIG.get("enable_idle_restart", False):
-            timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
-            
-            # 如果超时设置为-1，则禁用重启检查
-            if timeout == -1:
-                time.sleep(10) # 仍然需要休眠以避免繁忙循环
-                continue
-
-            idle_time = (datetime.now() - last_activity_time).total_seconds()
-            
-            if idle_time > timeout:
-                logger.info(f"服务器空闲时间 ({idle_time:.0f}s) 已超过阈值 ({timeout}s)。")
-                restart_server()
-                break # 退出循环，因为进程即将被替换
-                
-        # 每 10 秒检查一次
-        time.sleep(10)
+async def on_server_idle(idle_seconds: float):
+    """由 idle_timer 在服务器空闲超时（且没有进行中的响应流）时调用。"""
+    logger.info(f"服务器空闲时间 ({idle_seconds:.0f}s) 已超过阈值 ({idle_timer.timeout}s)。")
+    if CONFIG.get("idle_restart_mode", "soft") == "soft":
+        await soft_recycle("检测到服务器空闲超时")
+    else:
+        # restart_server 会阻塞等待通知发出后替换进程，在工作线程中执行
+        await asyncio.to_thread(restart_server)
 
 # --- FastAPI 生命周期事件 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在服务器启动时运行的生命周期函数。"""
-    global idle_monitor_thread, last_activity_time, main_event_loop
+    global main_event_loop, config_watcher_task, update_check_task, recycle_gate
     main_event_loop = asyncio.get_running_loop() # 获取主事件循环
+    recycle_gate = asyncio.Event()
+    recycle_gate.set()
     load_config() # 首先加载配置
+    log_setup.configure_logging(CONFIG) # 按 log_mode 启用生产日志模式
     
     # --- 打印当前的操作模式 ---
     mode = CONFIG.get("id_updater_last_mode", "direct_chat")
@@ -398,25 +611,28 @@ async def lifespan(app: FastAPI):
     logger.info("  (可通过运行 id_updater.py 修改模式)")
     logger.info("="*60)
 
-    check_for_updates() # 检查程序更新
+    update_check_task = asyncio.create_task(run_update_check()) # 在后台检查程序更新，不阻塞启动
     load_model_map() # 重新启用模型加载
     load_model_endpoint_map() # 加载模型端点映射
+    record_config_mtimes()
+    config_watcher_task = asyncio.create_task(config_watcher()) # 文件变化时自动热重载
     logger.info("服务器启动完成。等待油猴脚本连接...")
 
     # 检查并显示公告，放在启动信息的最后，使其更显眼
     check_and_display_announcement()
 
-    # 在模型更新后，标记活动时间的起点
-    last_activity_time = datetime.now()
-    
-    # 启动空闲监控线程
-    if CONFIG.get("enable_idle_restart", False):
-        idle_monitor_thread = threading.Thread(target=idle_monitor, daemon=True)
-        idle_monitor_thread.start()
-        
+    # 在模型更新后，标记活动时间的起点并开始空闲计时
+    idle_timer.start(on_server_idle)
 
     yield
+    idle_timer.stop()
+    config_watcher_task.cancel()
+    update_check_task.cancel()
+    await persistence.flush() # 确保防抖中的配置/模型文件在退出前写入
+    if file_uploader is not None:
+        await file_uploader.close_client()
     logger.info("服务器正在关闭。")
+    log_setup.shutdown_logging()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -431,8 +647,22 @@ app.add_middleware(
 )
 
 # --- 辅助函数 ---
+async def send_flow_control(request_id: str, command: str):
+    """向处理该请求的标签页发送 'pause' / 'resume' 流控指令。"""
+    worker = browser_pool.worker_for(request_id)
+    if worker:
+        await worker.send_command(command, request_id)
+
 def save_config():
-    """将当前的 CONFIG 对象写回 config.jsonc 文件，保留注释。"""
+    """
+    将当前的 CONFIG 对象写回 config.jsonc 文件，保留注释。
+    写入经过防抖并在后台线程中执行，写入时使用的是届时最新的 CONFIG 快照。
+    """
+    persistence.schedule('config.jsonc', _render_config)
+
+def _render_config():
+    """基于磁盘上的 config.jsonc 生成替换了会话信息的新内容（在工作线程中调用）。"""
+    config = CONFIG
     try:
         # 读取原始文件以保留注释等
         with open('config.jsonc', 'r', encoding='utf-8') as f:
@@ -450,14 +680,12 @@ def save_config():
             return content
 
         content_str = "".join(lines)
-        content_str = replacer("session_id", CONFIG["session_id"], content_str)
-        content_str = replacer("message_id", CONFIG["message_id"], content_str)
-        
-        with open('config.jsonc', 'w', encoding='utf-8') as f:
-            f.write(content_str)
-        logger.info("✅ 成功将会话信息更新到 config.jsonc。")
+        content_str = replacer("session_id", config["session_id"], content_str)
+        content_str = replacer("message_id", config["message_id"], content_str)
+        return content_str
     except Exception as e:
-        logger.error(f"❌ 写入 config.jsonc 时发生错误: {e}", exc_info=True)
+        logger.error(f"❌ 生成 config.jsonc 内容时发生错误: {e}", exc_info=True)
+        return None
 
 
 async def _process_openai_message(message: dict) -> dict:
@@ -515,11 +743,97 @@ async def _process_openai_message(message: dict) -> dict:
         "attachments": attachments
     }
 
-async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None) -> dict:
+file_uploader = None # 首次上传附件时才导入
+
+def _get_file_uploader():
+    """导入 file_uploader (及 httpx) 并创建共享连接池客户端，之后的上传复用其连接。"""
+    global file_uploader
+    if file_uploader is None:
+        from modules import file_uploader as module
+        module.open_client(max_connections=max(1, CONFIG.get("file_bed_upload_concurrency", 4)))
+        file_uploader = module
+    return file_uploader
+
+async def _upload_attachment(base64_url: str, file_name: str, upload_url: str, api_key: Optional[str],
+                             semaphore: asyncio.Semaphore) -> str:
+    """上传单个附件（或命中上传缓存），返回文件床上的最终 URL。"""
+    # 同一内容在缓存有效期内已上传过时直接复用，不再重复上传
+    digest = await asyncio.to_thread(content_key, base64_url)
+    uploaded_filename = attachment_cache.get(upload_url, digest) if digest else None
+    if uploaded_filename:
+        request_logger.info("文件床预处理：'%s' 命中上传缓存，复用 '%s'。", file_name, uploaded_filename)
+    else:
+        async with semaphore:
+            request_logger.info("文件床预处理：正在上传 '%s'...", file_name)
+            upload_started_at = time.monotonic()
+            uploaded_filename, error_message = await _get_file_uploader().upload_to_file_bed(file_name, base64_url, upload_url, api_key)
+            FILE_BED_UPLOAD_SECONDS.observe(time.monotonic() - upload_started_at, "error" if error_message else "success")
+
+        if error_message:
+            raise IOError(f"文件床上传失败: {error_message}")
+        if digest:
+            attachment_cache.put(upload_url, digest, uploaded_filename)
+
+    # 根据您的建议，使用 config 中的 URL 前缀构建最终 URL
+    url_prefix = upload_url.rsplit('/', 1)[0]
+    return f"{url_prefix}/uploads/{uploaded_filename}"
+
+async def upload_attachments_to_file_bed(messages: list, config: dict):
+    """
+    把消息中的所有 base64 图片并发上传到文件床，并将其替换为文件床 URL。
+    并发数由 file_bed_upload_concurrency 限制；同一请求中内容相同的附件只上传一次。
+    任一附件失败时取消其余上传并抛出 ValueError/IOError。
+    """
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    base64_url = part.get("image_url", {}).get("url")
+                    if not (base64_url and base64_url.startswith("data:")):
+                        raise ValueError(f"无效的图片数据格式: {base64_url[:100] if base64_url else 'None'}")
+                    parts.append(part)
+    if not parts:
+        return
+
+    upload_url = config.get("file_bed_upload_url")
+    if not upload_url:
+        raise ValueError("文件床已启用，但 'file_bed_upload_url' 未配置。")
+    # 确保处理转义的斜杠
+    upload_url = upload_url.replace('\\/', '/')
+    api_key = config.get("file_bed_api_key")
+    attachment_cache.configure(config)
+    semaphore = asyncio.Semaphore(max(1, config.get("file_bed_upload_concurrency", 4)))
+
+    uploads: dict[str, asyncio.Task] = {}  # data URI -> 上传任务
+    for part in parts:
+        image_url_data = part["image_url"]
+        base64_url = image_url_data["url"]
+        if base64_url not in uploads:
+            file_name = image_url_data.get("detail") or f"image_{uuid.uuid4()}.png"
+            uploads[base64_url] = asyncio.create_task(
+                _upload_attachment(base64_url, file_name, upload_url, api_key, semaphore))
+    try:
+        await asyncio.gather(*uploads.values())
+    except BaseException:
+        for task in uploads.values():
+            task.cancel()
+        raise
+
+    for part in parts:
+        final_url = uploads[part["image_url"]["url"]].result()
+        part["image_url"]["url"] = final_url
+        request_logger.info("附件URL已成功替换为: %s", final_url)
+
+async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None, config: Optional[dict] = None) -> dict:
     """
     将 OpenAI 请求体转换为油猴脚本所需的简化载荷，并应用酒馆模式、绕过模式以及对战模式。
     新增了模式覆盖参数，以支持模型特定的会话模式。
+    config 为请求入口处取得的配置快照，未提供时使用当前快照。
     """
+    if config is None:
+        config = CONFIG
     # 1. 规范化角色并处理消息
     #    - 将非标准的 'developer' 角色转换为 'system' 以提高兼容性。
     #    - 分离文本和附件。
@@ -527,7 +841,7 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     for msg in messages:
         if msg.get("role") == "developer":
             msg["role"] = "system"
-            logger.info("消息角色规范化：将 'developer' 转换为 'system'。")
+            request_logger.info("消息角色规范化：将 'developer' 转换为 'system'。")
             
     processed_messages = []
     for msg in messages:
@@ -535,7 +849,7 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
         processed_messages.append(processed_msg)
 
     # 2. 应用酒馆模式 (Tavern Mode)
-    if CONFIG.get("tavern_mode_enabled"):
+    if config.get("tavern_mode_enabled"):
         system_prompts = [msg['content'] for msg in processed_messages if msg['role'] == 'system']
         other_messages = [msg for msg in processed_messages if msg['role'] != 'system']
         
@@ -582,7 +896,7 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
                     break
             
             if has_images:
-                logger.info("检测到--bypass标记和图片附件，构造虚假助手消息")
+                request_logger.info("检测到--bypass标记和图片附件，构造虚假助手消息")
                 
                 # 移除用户消息中的--bypass标记
                 last_msg["content"] = last_msg["content"].strip()[:-9].strip()
@@ -602,7 +916,7 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
                 
                 # 检查是否需要在第一位添加虚假用户消息
                 if message_templates[0]["role"] == "assistant":
-                    logger.info("检测到第一条消息是助手消息，添加虚假用户消息...")
+                    request_logger.info("检测到第一条消息是助手消息，添加虚假用户消息...")
                     fake_user_msg = {
                         "role": "user",
                         "content": "Hi",
@@ -612,18 +926,18 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
 
     # 5. 应用绕过模式 (Bypass Mode) - 仅对文本模型生效
     model_type = model_info.get("type", "text")
-    if CONFIG.get("bypass_enabled") and model_type == "text":
+    if config.get("bypass_enabled") and model_type == "text":
         # 绕过模式总是添加一个 position 'a' 的用户消息
-        logger.info("绕过模式已启用，正在注入一个空的用户消息。")
+        request_logger.info("绕过模式已启用，正在注入一个空的用户消息。")
         message_templates.append({"role": "user", "content": " ", "participantPosition": "a", "attachments": []})
 
     # 6. 应用参与者位置 (Participant Position)
     # 优先使用覆盖的模式，否则回退到全局配置
-    mode = mode_override or CONFIG.get("id_updater_last_mode", "direct_chat")
-    target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
+    mode = mode_override or config.get("id_updater_last_mode", "direct_chat")
+    target_participant = battle_target_override or config.get("id_updater_battle_target", "A")
     target_participant = target_participant.lower() # 确保是小写
 
-    logger.info(f"正在根据模式 '{mode}' (目标: {target_participant if mode == 'battle' else 'N/A'}) 设置 Participant Positions...")
+    request_logger.info("正在根据模式 '%s' (目标: %s) 设置 Participant Positions...", mode, target_participant if mode == 'battle' else 'N/A')
 
     for msg in message_templates:
         if msg['role'] == 'system':
@@ -655,7 +969,7 @@ def format_openai_chunk(content: str, model: str, request_id: str) -> str:
         "created": int(time.time()), "model": model,
         "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    return f"data: {json_codec.dumps(chunk)}\n\n"
 
 def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
     """格式化为 OpenAI 结束块。"""
@@ -664,13 +978,52 @@ def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop'
         "created": int(time.time()), "model": model,
         "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
+    return f"data: {json_codec.dumps(chunk)}\n\ndata: [DONE]\n\n"
 
 def format_openai_error_chunk(error_message: str, model: str, request_id: str) -> str:
     """格式化为 OpenAI 错误块。"""
     content = f"\n\n[LMArena Bridge Error]: {error_message}"
     return format_openai_chunk(content, model, request_id)
 
+class OpenAIChunkEncoder:
+    """
+    单个流的 OpenAI SSE 块编码器。
+    id、model、created 在整个流中保持不变，因此 JSON 的前缀和后缀只渲染一次，
+    之后每个增量只需对 content 字符串本身做一次 JSON 转义并拼接。
+    输出与 format_openai_chunk 完全一致（created 在流开始时固定）。
+    """
+
+    def __init__(self, model: str, response_id: str):
+        self.model = model
+        self.response_id = response_id
+        self.created = int(time.time())
+        template = {
+            "id": response_id, "object": "chat.completion.chunk",
+            "created": self.created, "model": model,
+            "choices": [{"index": 0, "delta": {"content": 0}, "finish_reason": None}]
+        }
+        # 用占位值渲染一次模板，再从占位处切分出固定的前缀和后缀
+        head, _, tail = json_codec.dumps(template).rpartition('"content":0')
+        self._prefix = f'data: {head}"content":'
+        self._suffix = f"{tail}\n\n"
+
+    def chunk(self, content: str) -> str:
+        """格式化一个内容增量。"""
+        return self._prefix + json_codec.dumps(content) + self._suffix
+
+    def error(self, error_message: str) -> str:
+        """格式化一个错误内容块。"""
+        return self.chunk(f"\n\n[LMArena Bridge Error]: {error_message}")
+
+    def finish(self, reason: str = 'stop') -> str:
+        """格式化结束块（每个流只调用一次，无需预渲染）。"""
+        chunk = {
+            "id": self.response_id, "object": "chat.completion.chunk",
+            "created": self.created, "model": self.model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
+        }
+        return f"data: {json_codec.dumps(chunk)}\n\ndata: [DONE]\n\n"
+
 def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
     """构建符合 OpenAI 规范的非流式响应体。"""
     return {
@@ -690,46 +1043,49 @@ def format_openai_non_stream_response(content: str, model: str, request_id: str,
         },
     }
 
-async def _process_lmarena_stream(request_id: str):
+async def _process_lmarena_stream(request_id: str, config: Optional[dict] = None):
     """
     核心内部生成器：处理来自浏览器的原始数据流，并产生结构化事件。
     事件类型: ('content', str), ('finish', str), ('error', str)
+    config 为请求入口处取得的配置快照，未提供时使用当前快照。
     """
     global IS_REFRESHING_FOR_VERIFICATION
-    queue = response_channels.get(request_id)
-    if not queue:
+    channel = response_channels.get(request_id)
+    if not channel:
         logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 无法找到响应通道。")
         yield 'error', 'Internal server error: response channel not found.'
         return
 
-    buffer = ""
-    timeout = CONFIG.get("stream_response_timeout_seconds",360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    # 新增：用于匹配和提取图片URL的正则表达式
-    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
-    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
-    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+    # 增量解析器：每个字符只扫描一次，只保留末尾未完成的半行
+    parser = LMArenaStreamParser()
+    timeout = (config if config is not None else CONFIG).get("stream_response_timeout_seconds",360)
     
     has_yielded_content = False # 标记是否已产出过有效内容
+    outcome = "cancelled" # 请求结果，用于指标统计；消费方提前关闭生成器时保持为 cancelled
+    last_content_at = None
 
+    idle_timer.stream_started() # 进行中的响应流期间不会被判定为空闲
     try:
         while True:
             try:
-                raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
+                raw_data = await asyncio.wait_for(channel.get(), timeout=timeout)
             except asyncio.TimeoutError:
                 logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
+                outcome = "timeout"
                 yield 'error', f'Response timed out after {timeout} seconds.'
                 return
 
             # --- Cloudflare 人机验证处理 ---
             def handle_cloudflare_verification():
                 global IS_REFRESHING_FOR_VERIFICATION
-                if not IS_REFRESHING_FOR_VERIFICATION:
-                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 首次检测到人机验证，将发送刷新指令。")
+                CLOUDFLARE_EVENTS_TOTAL.inc()
+                worker = browser_pool.worker_for(request_id)
+                if worker and worker.healthy:
+                    # 只刷新触发验证的标签页，并在其重连前停止向它分派请求
+                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Worker [{worker.worker_id}] 首次检测到人机验证，将发送刷新指令。")
                     IS_REFRESHING_FOR_VERIFICATION = True
-                    if browser_ws:
-                        asyncio.create_task(browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False)))
+                    worker.healthy = False
+                    asyncio.create_task(worker.send_command("refresh"))
                     return "检测到人机验证，已发送刷新指令，请稍后重试。"
                 else:
                     logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 检测到人机验证，但已在刷新中，将等待。")
@@ -737,113 +1093,113 @@ async def _process_lmarena_stream(request_id: str):
 
             # 1. 检查来自 WebSocket 端的直接错误
             if isinstance(raw_data, dict) and 'error' in raw_data:
+                # 服务器自身中止的请求（断线、溢出、排空）不计为会话失败
+                outcome = raw_data.get("outcome") if raw_data.get("outcome") in SERVER_ABORT_OUTCOMES else "error"
                 error_msg = raw_data.get('error', 'Unknown browser error')
                 if isinstance(error_msg, str):
                     if '413' in error_msg or 'too large' in error_msg.lower():
                         friendly_error_msg = "上传失败：附件大小超过了 LMArena 服务器的限制 (通常是 5MB左右)。请尝试压缩文件或上传更小的文件。"
                         logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 检测到附件过大错误 (413)。")
+                        outcome = "attachment_error" # 与会话健康无关，不计为会话失败
                         yield 'error', friendly_error_msg
                         return
-                    if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
+                    if any(marker in error_msg.lower() for marker in CLOUDFLARE_MARKERS):
+                        outcome = "cloudflare" # 人机验证针对的是标签页，不计为会话失败
                         yield 'error', handle_cloudflare_verification()
                         return
                 yield 'error', error_msg
                 return
 
-            # 2. 检查 [DONE] 信号
-            if raw_data == "[DONE]":
-                # 状态重置逻辑已移至 websocket_endpoint，以确保连接恢复时状态一定被重置
-                if has_yielded_content and IS_REFRESHING_FOR_VERIFICATION:
-                     logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 请求成功，人机验证状态将在下次连接时重置。")
-                break
-
-            # 3. 累加缓冲区并检查内容
-            buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+            # 2. [DONE] 信号：处理流末尾可能没有换行符的最后一行后结束；
+            # 3. 否则增量解析新到达的数据块。两者产生的事件按同样的方式处理。
+            is_done = raw_data == "[DONE]"
+            if is_done:
+                events = parser.flush()
+            else:
+                chunk = "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+                events = parser.feed(chunk)
 
-            if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
-                yield 'error', handle_cloudflare_verification()
-                return
-            
-            if (error_match := error_pattern.search(buffer)):
-                try:
-                    error_json = json.loads(error_match.group(1))
-                    yield 'error', error_json.get("error", "来自 LMArena 的未知错误")
+            for event_type, data in events:
+                if event_type == 'cloudflare':
+                    outcome = "cloudflare"
+                    yield 'error', handle_cloudflare_verification()
                     return
-                except json.JSONDecodeError: pass
+                if event_type == 'error':
+                    outcome = "error"
+                    yield 'error', data
+                    return
+                if event_type == 'content':
+                    has_yielded_content = True
+                    now = time.monotonic()
+                    if last_content_at is None:
+                        TTFT_SECONDS.observe(now - channel.started_at, channel.model)
+                    else:
+                        INTER_TOKEN_SECONDS.observe(now - last_content_at, channel.model)
+                    last_content_at = now
+                yield event_type, data
 
-            # 优先处理文本内容
-            while (match := text_pattern.search(buffer)):
-                try:
-                    text_content = json.loads(f'"{match.group(1)}"')
-                    if text_content:
-                        has_yielded_content = True
-                        yield 'content', text_content
-                except (ValueError, json.JSONDecodeError): pass
-                buffer = buffer[match.end():]
-
-            # 新增：处理图片内容
-            while (match := image_pattern.search(buffer)):
-                try:
-                    image_data_list = json.loads(match.group(1))
-                    if isinstance(image_data_list, list) and image_data_list:
-                        image_info = image_data_list[0]
-                        if image_info.get("type") == "image" and "image" in image_info:
-                            # 将URL包装成Markdown格式并作为内容块yield
-                            markdown_image = f"![Image]({image_info['image']})"
-                            yield 'content', markdown_image
-                except (json.JSONDecodeError, IndexError) as e:
-                    logger.warning(f"解析图片URL时出错: {e}, buffer: {buffer[:150]}")
-                buffer = buffer[match.end():]
-
-            if (finish_match := finish_pattern.search(buffer)):
-                try:
-                    finish_data = json.loads(finish_match.group(1))
-                    yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError): pass
-                buffer = buffer[finish_match.end():]
+            if is_done:
+                outcome = "success"
+                # 状态重置逻辑已移至 websocket_endpoint，以确保连接恢复时状态一定被重置
+                if has_yielded_content and IS_REFRESHING_FOR_VERIFICATION:
+                     request_logger.info("PROCESSOR [ID: %.8s]: 请求成功，人机验证状态将在下次连接时重置。", request_id)
+                break
 
     except asyncio.CancelledError:
-        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 任务被取消。")
+        request_logger.info("PROCESSOR [ID: %.8s]: 任务被取消。", request_id)
     finally:
+        REQUESTS_TOTAL.inc(channel.model, outcome)
+        STREAM_DURATION_SECONDS.observe(time.monotonic() - channel.started_at, channel.model, outcome)
+        if outcome in ("cancelled", "timeout"):
+            # API 客户端已断开或等待超时：让油猴脚本中止该请求的 fetch，不再继续读取和回传
+            worker = browser_pool.worker_for(request_id)
+            if worker and worker.is_connected:
+                request_logger.info("PROCESSOR [ID: %.8s]: 通知 Worker [%s] 中止浏览器请求。", request_id, worker.worker_id)
+                asyncio.create_task(worker.send_command("cancel", request_id))
+        idle_timer.stream_finished()
+        channel.close()
+        admission.release(request_id)
+        session_pool.release(request_id, outcome)
         if request_id in response_channels:
             del response_channels[request_id]
-            logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 响应通道已清理。")
+            request_logger.info("PROCESSOR [ID: %.8s]: 响应通道已清理。", request_id)
 
-async def stream_generator(request_id: str, model: str):
+async def stream_generator(request_id: str, model: str, config: Optional[dict] = None):
     """将内部事件流格式化为 OpenAI SSE 响应。"""
     response_id = f"chatcmpl-{uuid.uuid4()}"
-    logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器启动。")
+    encoder = OpenAIChunkEncoder(model, response_id) # 每个流只预渲染一次固定字段
+    request_logger.info("STREAMER [ID: %.8s]: 流式生成器启动。", request_id)
     
     finish_reason_to_send = 'stop'  # 默认的结束原因
 
-    async for event_type, data in _process_lmarena_stream(request_id):
+    async for event_type, data in _process_lmarena_stream(request_id, config):
         if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
+            yield encoder.chunk(data)
         elif event_type == 'finish':
             # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
             finish_reason_to_send = data
             if data == 'content-filter':
                 warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
-                yield format_openai_chunk(warning_msg, model, response_id)
+                yield encoder.chunk(warning_msg)
         elif event_type == 'error':
             logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
+            yield encoder.error(str(data))
+            yield encoder.finish(reason='stop')
             return # 发生错误时，可以立即终止
 
     # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
-    logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
+    yield encoder.finish(reason=finish_reason_to_send)
+    request_logger.info("STREAMER [ID: %.8s]: 流式生成器正常结束。", request_id)
 
-async def non_stream_response(request_id: str, model: str):
+async def non_stream_response(request_id: str, model: str, config: Optional[dict] = None):
     """聚合内部事件流并返回单个 OpenAI JSON 响应。"""
     response_id = f"chatcmpl-{uuid.uuid4()}"
-    logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 开始处理非流式响应。")
+    request_logger.info("NON-STREAM [ID: %.8s]: 开始处理非流式响应。", request_id)
     
     full_content = []
     finish_reason = "stop"
     
-    async for event_type, data in _process_lmarena_stream(request_id):
+    async for event_type, data in _process_lmarena_stream(request_id, config):
         if event_type == 'content':
             full_content.append(data)
         elif event_type == 'finish':
@@ -864,73 +1220,133 @@ async def non_stream_response(request_id: str, model: str):
                     "code": "attachment_too_large" if status_code == 413 else "processing_error"
                 }
             }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+            return Response(content=json_codec.dumps_bytes(error_response), status_code=status_code, media_type="application/json")
 
     final_content = "".join(full_content)
     response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
     
-    logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 响应聚合完成。")
-    return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
+    request_logger.info("NON-STREAM [ID: %.8s]: 响应聚合完成。", request_id)
+    return Response(content=json_codec.dumps_bytes(response_data), media_type="application/json")
 
 # --- WebSocket 端点 ---
+def _handle_id_update(message: dict):
+    """处理油猴脚本发来的会话 ID 更新。"""
+    global CONFIG
+    new_session_id = message.get("session_id")
+    new_message_id = message.get("message_id")
+    if new_session_id and new_message_id:
+        logger.info(f"ID UPDATE: 收到新的会话信息: SessionID=...{new_session_id[-6:]}, MessageID=...{new_message_id[-6:]}")
+        # 构建新快照并整体替换，避免修改正在被请求读取的旧快照
+        CONFIG = {**CONFIG, 'session_id': new_session_id, 'message_id': new_message_id}
+        save_config() # 保存到 config.jsonc
+    else:
+        logger.warning(f"ID UPDATE: 收到的ID更新消息格式不完整: {message}")
+
+async def _handle_binary_message(worker, data: bytes):
+    """解析二进制帧协议消息（一条消息可能包含多个帧），并分发到对应请求。"""
+    try:
+        for frame_type, stream_id, payload in bp.iter_frames(data):
+            if frame_type == bp.FRAME_ID_UPDATE:
+                _handle_id_update(json_codec.loads(payload))
+                continue
+
+            request_id = worker.streams.get(stream_id)
+            if not request_id:
+                logger.warning(f"⚠️ 收到未知或已关闭流的响应: Worker [{worker.worker_id}] stream {stream_id}")
+                continue
+
+            if frame_type == bp.FRAME_DATA:
+                await _dispatch_browser_data(request_id, payload.decode('utf-8'), None)
+            elif frame_type == bp.FRAME_DONE:
+                await _dispatch_browser_data(request_id, "[DONE]", None)
+            elif frame_type == bp.FRAME_ERROR:
+                await _dispatch_browser_data(request_id, {"error": payload.decode('utf-8')}, None)
+    except (bp.ProtocolError, UnicodeDecodeError, json_codec.JSONDecodeError) as e:
+        logger.error(f"Worker [{worker.worker_id}] 发送了无法解析的二进制消息: {e}")
+
+async def _dispatch_browser_data(request_id: Optional[str], data, message: Optional[dict]):
+    """将浏览器发来的一个数据块放入对应请求的响应通道。"""
+    if not request_id or data is None:
+        logger.warning(f"收到来自浏览器的无效消息: {message}")
+        return
+
+    channel = response_channels.get(request_id)
+    if channel:
+        if not await channel.put(data):
+            # 该请求的缓冲已超过硬上限并被中止：让浏览器停止读取，其余请求不受影响
+            worker = browser_pool.worker_for(request_id)
+            if worker and worker.is_connected:
+                asyncio.create_task(worker.send_command("cancel", request_id))
+    else:
+        logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """处理来自油猴脚本的 WebSocket 连接。"""
-    global browser_ws, IS_REFRESHING_FOR_VERIFICATION
+    """
+    处理来自油猴脚本的 WebSocket 连接。每个标签页注册为一个独立的 Worker。
+    支持两种协议：JSON 文本协议 (旧脚本) 和握手后启用的二进制帧协议。
+    """
+    global IS_REFRESHING_FOR_VERIFICATION
     await websocket.accept()
-    if browser_ws is not None:
-        logger.warning("检测到新的油猴脚本连接，旧的连接将被替换。")
     
     # 只要有新的连接建立，就意味着人机验证流程已结束（或从未开始）
     if IS_REFRESHING_FOR_VERIFICATION:
         logger.info("✅ 新的 WebSocket 连接已建立，人机验证状态已自动重置。")
         IS_REFRESHING_FOR_VERIFICATION = False
         
-    logger.info("✅ 油猴脚本已成功连接 WebSocket。")
-    browser_ws = websocket
+    worker = browser_pool.register(websocket)
+    logger.info(f"✅ 油猴脚本已成功连接 WebSocket (Worker: {worker.worker_id})。")
+    admission.wake() # 新标签页带来了新的容量，让排队中的请求先行
     try:
         while True:
-            # 等待并接收来自油猴脚本的消息
-            message_str = await websocket.receive_text()
-            message = json.loads(message_str)
+            # 等待并接收来自油猴脚本的消息（文本为 JSON 协议，二进制为帧协议）
+            ws_message = await websocket.receive()
+            if ws_message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(ws_message.get("code", 1000))
+
+            if ws_message.get("bytes") is not None:
+                worker.record_received(len(ws_message["bytes"]))
+                await _handle_binary_message(worker, ws_message["bytes"])
+                continue
+
+            text = ws_message.get("text") or "{}"
+            worker.record_received(len(text))
+            message = json_codec.loads(text)
+
+            # --- 协议握手：支持二进制帧协议的脚本会先发送 hello ---
+            if message.get("type") == "hello":
+                if message.get("protocol", 1) >= bp.PROTOCOL_VERSION:
+                    worker.protocol = bp.PROTOCOL_VERSION
+                    await worker.send_json({"type": "hello_ack", "protocol": bp.PROTOCOL_VERSION})
+                    logger.info(f"Worker [{worker.worker_id}] 已切换到二进制帧协议 (v{bp.PROTOCOL_VERSION})。")
+                continue
 
             # --- 新增：处理专门的ID更新消息 ---
             if message.get("type") == "id_update":
-                new_session_id = message.get("session_id")
-                new_message_id = message.get("message_id")
-                if new_session_id and new_message_id:
-                    logger.info(f"ID UPDATE: 收到新的会话信息: SessionID=...{new_session_id[-6:]}, MessageID=...{new_message_id[-6:]}")
-                    CONFIG['session_id'] = new_session_id
-                    CONFIG['message_id'] = new_message_id
-                    save_config() # 保存到 config.jsonc
-                else:
-                    logger.warning(f"ID UPDATE: 收到的ID更新消息格式不完整: {message}")
+                _handle_id_update(message)
                 continue # 处理完后继续等待下一条消息
 
-            request_id = message.get("request_id")
-            data = message.get("data")
-
-            if not request_id or data is None:
-                logger.warning(f"收到来自浏览器的无效消息: {message}")
+            # 合并帧：油猴脚本把一段时间内多个请求的数据块合并为一帧发送
+            batch = message.get("batch")
+            if isinstance(batch, list):
+                for entry in batch:
+                    await _dispatch_browser_data(entry.get("request_id"), entry.get("data"), entry)
                 continue
 
-            # 将收到的数据放入对应的响应通道
-            if request_id in response_channels:
-                await response_channels[request_id].put(data)
-            else:
-                logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
+            await _dispatch_browser_data(message.get("request_id"), message.get("data"), message)
 
     except WebSocketDisconnect:
-        logger.warning("❌ 油猴脚本客户端已断开连接。")
+        logger.warning(f"❌ 油猴脚本客户端 (Worker: {worker.worker_id}) 已断开连接。")
     except Exception as e:
-        logger.error(f"WebSocket 处理时发生未知错误: {e}", exc_info=True)
+        logger.error(f"WebSocket 处理时发生未知错误 (Worker: {worker.worker_id}): {e}", exc_info=True)
     finally:
-        browser_ws = None
-        # 清理所有等待的响应通道，以防请求被挂起
-        for queue in response_channels.values():
-            await queue.put({"error": "Browser disconnected during operation"})
-        response_channels.clear()
-        logger.info("WebSocket 连接已清理。")
+        # 只让该标签页上的在途请求失败，其他标签页上的请求不受影响
+        orphaned = browser_pool.unregister(worker)
+        for request_id in orphaned:
+            channel = response_channels.pop(request_id, None)
+            if channel:
+                channel.fail("Browser disconnected during operation", "disconnected")
+        logger.info(f"WebSocket 连接已清理 (Worker: {worker.worker_id})。")
 
 # --- OpenAI 兼容 API 端点 ---
 @app.get("/v1/models")
@@ -961,13 +1377,14 @@ async def request_model_update():
     接收来自 model_updater.py 的请求，并通过 WebSocket 指令
     让油猴脚本发送页面源码。
     """
-    if not browser_ws:
+    worker = browser_pool.any_worker()
+    if not worker:
         logger.warning("MODEL UPDATE: 收到更新请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
     
     try:
-        logger.info("MODEL UPDATE: 收到更新请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "send_page_source"}))
+        logger.info(f"MODEL UPDATE: 收到更新请求，正在通过 WebSocket 向 Worker [{worker.worker_id}] 发送指令...")
+        await worker.send_command("send_page_source")
         logger.info("MODEL UPDATE: 'send_page_source' 指令已成功发送。")
         return JSONResponse({"status": "success", "message": "Request to send page source sent."})
     except Exception as e:
@@ -988,7 +1405,8 @@ async def update_available_models_endpoint(request: Request):
         )
     
     logger.info("收到来自油猴脚本的页面内容，开始提取可用模型...")
-    new_models_list = extract_models_from_html(html_content.decode('utf-8'))
+    # 提取是 CPU 密集型操作，放到工作线程中执行，避免阻塞正在进行的流式响应
+    new_models_list = await asyncio.to_thread(extract_models_from_html, html_content.decode('utf-8'))
     
     if new_models_list:
         save_available_models(new_models_list)
@@ -1009,13 +1427,14 @@ async def chat_completions(request: Request):
     接收 OpenAI 格式的请求，将其转换为 LMArena 格式，
     通过 WebSocket 发送给油猴脚本，然后流式返回结果。
     """
-    global last_activity_time
-    last_activity_time = datetime.now() # 更新活动时间
-    logger.info(f"API请求已收到，活动时间已更新为: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    started_at = time.monotonic() # 用于统计首字延迟与总耗时
+    idle_timer.touch() # 更新活动时间
+    log_setup.sample_request() # 生产日志模式下决定该请求的 INFO 日志是否输出
+    request_logger.info("API请求已收到，活动时间已更新。")
 
     try:
-        openai_req = await request.json()
-    except json.JSONDecodeError:
+        openai_req = json_codec.loads(await request.body())
+    except json_codec.JSONDecodeError:
         raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
 
     model_name = openai_req.get("model")
@@ -1024,17 +1443,21 @@ async def chat_completions(request: Request):
 
     # --- 新增：基于模型类型的判断逻辑 ---
     if model_type == 'image':
-        logger.info(f"检测到模型 '{model_name}' 类型为 'image'，将通过主聊天接口处理。")
+        request_logger.info("检测到模型 '%s' 类型为 'image'，将通过主聊天接口处理。", model_name)
         # 对于图像模型，我们不再调用独立的处理器，而是复用主聊天逻辑，
         # 因为 _process_lmarena_stream 现在已经能处理图片数据。
         # 这意味着图像生成现在原生支持流式和非流式响应。
         pass # 继续执行下面的通用聊天逻辑
     # --- 文生图逻辑结束 ---
 
-    # 如果不是图像模型，则执行正常的文本生成逻辑
-    load_config()  # 实时加载最新配置，确保会话ID等信息是最新的
+    # 软重启进行中时等待其完成，使请求使用重置后的状态和配置
+    await recycle_gate.wait()
+
+    # 取得当前配置快照的引用。配置文件的变化由 config_watcher 在后台热重载，
+    # 请求路径上不再读取或解析文件。
+    config = CONFIG
     # --- API Key 验证 ---
-    api_key = CONFIG.get("api_key")
+    api_key = config.get("api_key")
     if api_key:
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith('Bearer '):
@@ -1051,13 +1474,13 @@ async def chat_completions(request: Request):
             )
 
     # --- 增强的连接检查，解决人机验证后的竞态条件 ---
-    if IS_REFRESHING_FOR_VERIFICATION and not browser_ws:
+    if IS_REFRESHING_FOR_VERIFICATION and not browser_pool.has_healthy_worker():
         raise HTTPException(
             status_code=503,
             detail="正在等待浏览器刷新以完成人机验证，请在几秒钟后重试。"
         )
 
-    if not browser_ws:
+    if not browser_pool.has_healthy_worker():
         raise HTTPException(
             status_code=503,
             detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。"
@@ -1066,17 +1489,22 @@ async def chat_completions(request: Request):
     # --- 模型与会话ID映射逻辑 ---
     session_id, message_id = None, None
     mode_override, battle_target_override = None, None
+    fingerprints = None # 对话前缀指纹，用于多轮对话的会话亲和
 
     if model_name and model_name in MODEL_ENDPOINT_MAP:
         mapping_entry = MODEL_ENDPOINT_MAP[model_name]
         selected_mapping = None
 
         if isinstance(mapping_entry, list) and mapping_entry:
-            selected_mapping = random.choice(mapping_entry)
-            logger.info(f"为模型 '{model_name}' 从ID列表中随机选择了一个映射。")
+            session_pool.configure(config)
+            if len(mapping_entry) > 1 and session_pool.affinity_enabled:
+                # 历史中可能包含大量 base64 附件，哈希在工作线程中进行，避免阻塞事件循环
+                fingerprints = await asyncio.to_thread(prefix_fingerprints, openai_req.get("messages") or [])
+            selected_mapping = session_pool.choose(mapping_entry, fingerprints)
+            request_logger.info("为模型 '%s' 从ID列表中按对话亲和、负载与健康状况选择了一个映射。", model_name)
         elif isinstance(mapping_entry, dict):
             selected_mapping = mapping_entry
-            logger.info(f"为模型 '{model_name}' 找到了单个端点映射（旧格式）。")
+            request_logger.info("为模型 '%s' 找到了单个端点映射（旧格式）。", model_name)
         
         if selected_mapping:
             session_id = selected_mapping.get("session_id")
@@ -1084,22 +1512,18 @@ async def chat_completions(request: Request):
             # 关键：同时获取模式信息
             mode_override = selected_mapping.get("mode") # 可能为 None
             battle_target_override = selected_mapping.get("battle_target") # 可能为 None
-            log_msg = f"将使用 Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
-            if mode_override:
-                log_msg += f" (模式: {mode_override}"
-                if mode_override == 'battle':
-                    log_msg += f", 目标: {battle_target_override or 'A'}"
-                log_msg += ")"
-            logger.info(log_msg)
+            request_logger.info("将使用 Session ID: ...%s (模式: %s, 目标: %s)",
+                                session_id[-6:] if session_id else 'N/A', mode_override or '默认',
+                                (battle_target_override or 'A') if mode_override == 'battle' else 'N/A')
 
     # 如果经过以上处理，session_id 仍然是 None，则进入全局回退逻辑
     if not session_id:
-        if CONFIG.get("use_default_ids_if_mapping_not_found", True):
-            session_id = CONFIG.get("session_id")
-            message_id = CONFIG.get("message_id")
+        if config.get("use_default_ids_if_mapping_not_found", True):
+            session_id = config.get("session_id")
+            message_id = config.get("message_id")
             # 当使用全局ID时，不设置模式覆盖，让其使用全局配置
             mode_override, battle_target_override = None, None
-            logger.info(f"模型 '{model_name}' 未找到有效映射，根据配置使用全局默认 Session ID: ...{session_id[-6:] if session_id else 'N/A'}")
+            request_logger.info("模型 '%s' 未找到有效映射，根据配置使用全局默认 Session ID: ...%s", model_name, session_id[-6:] if session_id else 'N/A')
         else:
             logger.error(f"模型 '{model_name}' 未在 'model_endpoint_map.json' 中找到有效映射，且已禁用回退到默认ID。")
             raise HTTPException(
@@ -1118,47 +1542,21 @@ async def chat_completions(request: Request):
         logger.warning(f"请求的模型 '{model_name}' 不在 models.json 中，将使用默认模型ID。")
 
     request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
-    logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道。")
+    response_channels[request_id] = ResponseChannel(
+        request_id,
+        high_water_bytes=config.get("response_buffer_high_water_bytes", DEFAULT_HIGH_WATER_BYTES),
+        on_flow_control=lambda command: send_flow_control(request_id, command),
+        model=_model_label(model_name),
+        started_at=started_at,
+    )
+    session_pool.acquire(request_id, session_id, fingerprints[-1] if fingerprints else None)
+    request_logger.info("API CALL [ID: %.8s]: 已创建响应通道。", request_id)
 
     try:
         # --- 附件预处理（包括文件床上传） ---
         # 在与浏览器通信前，先处理好所有附件。如果失败，则立即返回错误。
-        messages_to_process = openai_req.get("messages", [])
-        for message in messages_to_process:
-            content = message.get("content")
-            if isinstance(content, list):
-                for i, part in enumerate(content):
-                    if part.get("type") == "image_url" and CONFIG.get("file_bed_enabled"):
-                        image_url_data = part.get("image_url", {})
-                        base64_url = image_url_data.get("url")
-                        original_filename = image_url_data.get("detail")
-                        
-                        if not (base64_url and base64_url.startswith("data:")):
-                            raise ValueError(f"无效的图片数据格式: {base64_url[:100] if base64_url else 'None'}")
-
-                        upload_url = CONFIG.get("file_bed_upload_url")
-                        if not upload_url:
-                            raise ValueError("文件床已启用，但 'file_bed_upload_url' 未配置。")
-                        
-                        # 确保处理转义的斜杠
-                        upload_url = upload_url.replace('\\/', '/')
-
-                        api_key = CONFIG.get("file_bed_api_key")
-                        file_name = original_filename or f"image_{uuid.uuid4()}.png"
-                        
-                        logger.info(f"文件床预处理：正在上传 '{file_name}'...")
-                        uploaded_filename, error_message = await upload_to_file_bed(file_name, base64_url, upload_url, api_key)
-
-                        if error_message:
-                            raise IOError(f"文件床上传失败: {error_message}")
-                        
-                        # 根据您的建议，使用 config 中的 URL 前缀构建最终 URL
-                        url_prefix = upload_url.rsplit('/', 1)[0]
-                        final_url = f"{url_prefix}/uploads/{uploaded_filename}"
-                        
-                        part["image_url"]["url"] = final_url
-                        logger.info(f"附件URL已成功替换为: {final_url}")
+        if config.get("file_bed_enabled"):
+            await upload_attachments_to_file_bed(openai_req.get("messages", []), config)
 
         # 1. 转换请求 (此时已不包含需要上传的附件)
         lmarena_payload = await convert_openai_to_lmarena_payload(
@@ -1166,7 +1564,8 @@ async def chat_completions(request: Request):
             session_id,
             message_id,
             mode_override=mode_override,
-            battle_target_override=battle_target_override
+            battle_target_override=battle_target_override,
+            config=config
         )
         
         # 关键补充：如果模型是图片类型，则向油猴脚本明确指出
@@ -1179,9 +1578,16 @@ async def chat_completions(request: Request):
             "payload": lmarena_payload
         }
         
-        # 3. 通过 WebSocket 发送
-        logger.info(f"API CALL [ID: {request_id[:8]}]: 正在通过 WebSocket 发送载荷到油猴脚本。")
-        await browser_ws.send_text(json.dumps(message_to_browser))
+        # 3. 准入控制：取得一个标签页槽位（可能需要排队），然后通过 WebSocket 发送
+        admission.configure(config)
+        try:
+            priority = int(request.headers.get("X-Priority", 0))
+        except ValueError:
+            priority = 0
+        worker = await admission.acquire(request_id, session_id, priority)
+        message_to_browser["stream_id"] = worker.stream_ids[request_id]
+        request_logger.info("API CALL [ID: %.8s]: 正在通过 WebSocket 发送载荷到油猴脚本 (Worker: %s, 在途: %d)。", request_id, worker.worker_id, worker.load)
+        await worker.send_json(message_to_browser)
 
         # 4. 根据 stream 参数决定返回类型
         is_stream = openai_req.get("stream", False)
@@ -1189,15 +1595,40 @@ async def chat_completions(request: Request):
         if is_stream:
             # 返回流式响应
             return StreamingResponse(
-                stream_generator(request_id, model_name or "default_model"),
+                stream_generator(request_id, model_name or "default_model", config),
                 media_type="text/event-stream"
             )
         else:
             # 返回非流式响应
-            return await non_stream_response(request_id, model_name or "default_model")
+            return await non_stream_response(request_id, model_name or "default_model", config)
+    except asyncio.CancelledError:
+        # 客户端在附件上传或排队期间断开：请求尚未交给浏览器（或已交给浏览器则让其中止），清理后继续传播取消
+        if request_id in response_channels:
+            worker = browser_pool.worker_for(request_id)
+            if worker and worker.is_connected:
+                asyncio.create_task(worker.send_command("cancel", request_id))
+            admission.release(request_id)
+            session_pool.release(request_id, "cancelled")
+            REQUESTS_TOTAL.inc(_model_label(model_name), "cancelled")
+            del response_channels[request_id]
+        raise
+    except AdmissionRejected as e:
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: 未被准入: {e}")
+        REQUESTS_TOTAL.inc(_model_label(model_name), "rejected")
+        session_pool.release(request_id, "rejected")
+        if request_id in response_channels:
+            del response_channels[request_id]
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+            content={"error": {"message": f"[LMArena Bridge Error]: {e}", "type": "rate_limit_error", "code": "server_busy"}}
+        )
     except (ValueError, IOError) as e:
         # 捕获附件处理错误
         logger.error(f"API CALL [ID: {request_id[:8]}]: 附件预处理失败: {e}")
+        REQUESTS_TOTAL.inc(_model_label(model_name), "error")
+        admission.release(request_id)
+        session_pool.release(request_id, "attachment_error") # 附件问题与会话无关，不计为会话失败
         if request_id in response_channels:
             del response_channels[request_id]
         # 返回一个格式正确的JSON错误响应
@@ -1207,6 +1638,9 @@ async def chat_completions(request: Request):
         )
     except Exception as e:
         # 捕获所有其他错误
+        REQUESTS_TOTAL.inc(_model_label(model_name), "error")
+        admission.release(request_id)
+        session_pool.release(request_id, "error")
         if request_id in response_channels:
             del response_channels[request_id]
         logger.error(f"API CALL [ID: {request_id[:8]}]: 处理请求时发生致命错误: {e}", exc_info=True)
@@ -1216,20 +1650,69 @@ async def chat_completions(request: Request):
             content={"error": {"message": str(e), "type": "internal_server_error"}}
         )
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """以 Prometheus 文本格式导出请求、延迟、WebSocket 流量和准入控制指标。"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- 内部通信端点 ---
+@app.get("/internal/admission")
+async def admission_stats():
+    """返回准入控制的队列深度、排队等待时间及各会话的在途请求数。"""
+    return admission.stats()
+
+@app.get("/internal/channels")
+async def list_response_channels():
+    """返回每个在途请求当前缓冲的数据量及流控状态。"""
+    channels = {request_id[:8]: channel.stats() for request_id, channel in list(response_channels.items())}
+    return {
+        "active_channels": len(channels),
+        "total_buffered_bytes": sum(c["buffered_bytes"] for c in channels.values()),
+        "channels": channels,
+    }
+
+@app.get("/internal/attachment_cache")
+async def attachment_cache_stats():
+    """返回文件床上传缓存的条目数与命中率。"""
+    return attachment_cache.stats()
+
+@app.get("/internal/sessions")
+async def list_sessions():
+    """返回模型映射中各会话 ID 的成功率、平均耗时、在途数、剔除状态及对话亲和命中率。"""
+    return {"ejections_total": session_pool.ejections_total, "affinity": session_pool.affinity_stats(),
+            "sessions": session_pool.snapshot()}
+
+@app.get("/internal/update_status")
+async def get_update_status():
+    """返回最近一次后台更新检查的结果。"""
+    return update_status
+
+@app.get("/internal/workers")
+async def list_browser_workers():
+    """返回当前已连接的浏览器标签页 (Worker) 及其负载。"""
+    return {"workers": browser_pool.snapshot()}
+
+@app.post("/internal/recycle")
+async def recycle_server():
+    """手动触发进程内软重启（例如由外部守护进程调用，代替杀死并重启进程）。"""
+    if not await soft_recycle("收到软重启请求"):
+        raise HTTPException(status_code=409, detail="Recycle already in progress.")
+    return {"status": "success", "recycles_total": recycles_total}
+
 @app.post("/internal/start_id_capture")
 async def start_id_capture():
     """
     接收来自 id_updater.py 的通知，并通过 WebSocket 指令
     激活油猴脚本的 ID 捕获模式。
     """
-    if not browser_ws:
+    worker = browser_pool.any_worker()
+    if not worker:
         logger.warning("ID CAPTURE: 收到激活请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
     
     try:
-        logger.info("ID CAPTURE: 收到激活请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
+        logger.info(f"ID CAPTURE: 收到激活请求，正在通过 WebSocket 向 Worker [{worker.worker_id}] 发送指令...")
+        await worker.send_command("activate_id_capture")
         logger.info("ID CAPTURE: 激活指令已成功发送。")
         return JSONResponse({"status": "success", "message": "Activation command sent."})
     except Exception as e:
@@ -0,0 +1,94 @@
+# benchmarks/bench_import_time.py
+# 导入耗时基准：用 `python -X importtime` 在全新进程中导入入口模块，汇总耗时最多的模块，
+# 并检查应当延迟导入的模块（更新检查、文件床上传才用到的依赖）没有在启动时被加载。
+#
+# 存在应延迟导入却被提前导入的模块时以退出码 1 结束，可作为回归检查；
+# 使用 --baseline 时，总耗时比基线慢超过 --tolerance 也视为回归。
+#
+# 用法:
+#   python benchmarks/bench_import_time.py
+#   python benchmarks/bench_import_time.py --top 30 --repeat 5
+#   python benchmarks/bench_import_time.py --save import_baseline.json
+#   python benchmarks/bench_import_time.py --baseline import_baseline.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 启动路径上不应出现的顶层模块
+LAZY_MODULES = ("requests", "packaging", "httpx", "modules.file_uploader")
+
+
+def profile_import(module: str) -> dict[str, tuple[int, int]]:
+    """在新进程中导入模块，返回 {模块名: (自身耗时 us, 累计耗时 us)}。"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr.splitlines()[-1] if result.stderr else ''}")
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        # 格式: "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="入口模块导入耗时基准")
+    parser.add_argument("--module", default="api_server", help="要导入的模块")
+    parser.add_argument("--top", type=int, default=20, help="显示累计耗时最多的前 N 个模块")
+    parser.add_argument("--repeat", type=int, default=3, help="运行次数（总耗时取中位数）")
+    parser.add_argument("--save", help="把本次总耗时与模块列表保存为基线 JSON")
+    parser.add_argument("--baseline", help="与之前保存的基线 JSON 比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许比基线慢的比例")
+    args = parser.parse_args()
+
+    runs = [profile_import(args.module) for _ in range(args.repeat)]
+    totals = [run[args.module][1] for run in runs]
+    total_us = statistics.median(totals)
+    timings = runs[totals.index(min(totals))]
+
+    print(f"--- import {args.module}: 中位数 {total_us / 1000:.1f} ms, 共 {len(timings)} 个模块 ---")
+    print(f"{'累计 (ms)':>10} {'自身 (ms)':>10}  模块")
+    ranked = sorted(timings.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_us, cumulative_us) in ranked[:args.top]:
+        print(f"{cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name}")
+
+    failed = False
+    eager = [name for name in LAZY_MODULES if name in timings]
+    if eager:
+        print(f"❌ 以下模块应延迟导入，但在启动时被加载: {', '.join(eager)}")
+        failed = True
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        ratio = total_us / baseline["total_us"]
+        new_modules = sorted(set(timings) - set(baseline["modules"]))
+        print(f"与基线相比: {ratio:.2f}x (基线 {baseline['total_us'] / 1000:.1f} ms)")
+        if new_modules:
+            print(f"新增导入的模块 ({len(new_modules)}): {', '.join(new_modules[:args.top])}")
+        if ratio > 1 + args.tolerance:
+            print(f"❌ 导入耗时超过基线 {args.tolerance:.0%} 以上。")
+            failed = True
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"module": args.module, "total_us": total_us, "modules": sorted(timings)}, f, indent=2)
+        print(f"基线已保存到 '{args.save}'。")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
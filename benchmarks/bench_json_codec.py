@@ -0,0 +1,101 @@
+# benchmarks/bench_json_codec.py
+# JSON 编解码后端基准：用每个可用后端 (json / orjson) 重放一次完整请求的热路径，
+# 比较每个请求的 CPU 耗时。
+#
+# 覆盖的调用点：请求体解析、发往浏览器的载荷序列化、每个 WebSocket 帧的解析、
+# 流式文本的反转义 (LMArenaStreamParser) 以及每个 SSE 块的编码。
+#
+# 用法:
+#   python benchmarks/bench_json_codec.py
+#   python benchmarks/bench_json_codec.py --requests 50 --tokens 4000
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import json_codec
+from modules.stream_parser import LMArenaStreamParser
+
+
+def make_request_body(history_turns: int) -> bytes:
+    messages = [{"role": "system", "content": "You are a helpful assistant. " * 20}]
+    for i in range(history_turns):
+        messages.append({"role": "user", "content": f"问题 {i}: " + "lorem ipsum dolor sit amet " * 30})
+        messages.append({"role": "assistant", "content": f"回答 {i}: " + "consectetur adipiscing elit " * 60})
+    messages.append({"role": "user", "content": "Continue."})
+    return json_codec.BACKENDS["json"][2]({"model": "claude-3-5-sonnet-20241022", "stream": True, "messages": messages})
+
+
+def make_ws_frames(tokens: int, seed: int = 0) -> list[str]:
+    """模拟合并后的 WebSocket 文本帧：每帧包含若干 a0 行。"""
+    rng = random.Random(seed)
+    samples = [" the", " model", "你好", "，", " \"quoted\"", "\\n", " token", " code`"]
+    std_dumps = json_codec.BACKENDS["json"][1]
+    frames, lines = [], []
+    for i in range(tokens):
+        lines.append(f'a0:{std_dumps(rng.choice(samples))}\n')
+        if len(lines) >= 8:
+            frames.append(std_dumps({"request_id": "00000000-0000-0000-0000-000000000000", "data": "".join(lines)}))
+            lines = []
+    lines.append('ad:{"finishReason":"stop"}\n')
+    frames.append(std_dumps({"request_id": "00000000-0000-0000-0000-000000000000", "data": "".join(lines)}))
+    return frames
+
+
+def run_request(body: bytes, frames: list[str]) -> int:
+    """按 api_server 的顺序调用 json_codec，返回产出的 SSE 块数。"""
+    request = json_codec.loads(body)
+    json_codec.dumps({"request_id": "00000000-0000-0000-0000-000000000000",
+                      "payload": {"message_templates": request["messages"], "session_id": "s", "message_id": "m"}})
+    parser = LMArenaStreamParser()
+    prefix = 'data: {"id":"chatcmpl-x","object":"chat.completion.chunk","created":0,"model":"m","choices":[{"index":0,"delta":{"content":'
+    suffix = '},"finish_reason":null}]}\n\n'
+    emitted = 0
+    for frame in frames:
+        message = json_codec.loads(frame)
+        for event_type, data in parser.feed(message["data"]):
+            if event_type == 'content':
+                prefix + json_codec.dumps(data) + suffix
+                emitted += 1
+    return emitted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON 编解码后端基准")
+    parser.add_argument("--requests", type=int, default=20, help="每个后端重放的请求数")
+    parser.add_argument("--tokens", type=int, default=3000, help="每个请求的流式 token 数")
+    parser.add_argument("--history", type=int, default=20, help="请求中的历史对话轮数")
+    args = parser.parse_args()
+
+    body = make_request_body(args.history)
+    frames = make_ws_frames(args.tokens)
+    print(f"请求体: {len(body) / 1024:.1f} KB, WebSocket 帧: {len(frames)}, 当前默认后端: {json_codec.BACKEND}")
+
+    original = (json_codec.loads, json_codec.dumps, json_codec.dumps_bytes)
+    results = {}
+    try:
+        for name, (loads, dumps, dumps_bytes) in json_codec.BACKENDS.items():
+            json_codec.loads, json_codec.dumps, json_codec.dumps_bytes = loads, dumps, dumps_bytes
+            run_request(body, frames)  # 预热
+            start = time.process_time()
+            for _ in range(args.requests):
+                run_request(body, frames)
+            per_request = (time.process_time() - start) / args.requests
+            results[name] = per_request
+            print(f"[{name:<6}] 每请求 CPU: {per_request * 1000:.2f} ms")
+    finally:
+        json_codec.loads, json_codec.dumps, json_codec.dumps_bytes = original
+
+    if "orjson" in results:
+        saving = 1 - results["orjson"] / results["json"]
+        print(f"orjson 每请求节省 CPU: {(results['json'] - results['orjson']) * 1000:.2f} ms ({saving:.0%})")
+    else:
+        print("未安装 orjson (pip install orjson)，仅测量了标准库后端。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# benchmarks/bench_model_extractor.py
+# 模型提取基准：比较旧的括号匹配实现与基于 flight 数据单次扫描的新实现。
+#
+# 没有指定页面快照时，用 available_models.json 合成一个与 LMArena 结构相近的页面：
+# 模型列表被编码进多个 self.__next_f.push([1,"..."]) 数据块（对象可能跨块），
+# 前后混入大量无关的 HTML 与 flight 数据。
+#
+# 用法:
+#   python benchmarks/bench_model_extractor.py
+#   python benchmarks/bench_model_extractor.py --filler-mb 8
+#   python benchmarks/bench_model_extractor.py --snapshot page1.html page2.html
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from modules.model_extractor import extract_models_from_html, extract_models_legacy
+
+
+def make_page(models: list[dict], filler_mb: float, seed: int = 0) -> str:
+    """把模型列表嵌入合成的 Next.js 页面。"""
+    rng = random.Random(seed)
+    filler_item = {"id": "00000000-0000-0000-0000-000000000000", "type": "message", "content": "lorem ipsum " * 20}
+    filler = []
+    total, target = 0, int(filler_mb * 1024 * 1024)
+    while total < target:
+        piece = f'{rng.randint(1, 999):x}:' + json.dumps([filler_item] * rng.randint(1, 8), ensure_ascii=False, separators=(",", ":")) + "\n"
+        filler.append(piece)
+        total += len(piece)
+
+    half = len(filler) // 2
+    flight = "".join(filler[:half]) + "a:" + json.dumps({"initialModels": models}, ensure_ascii=False, separators=(",", ":")) + "\n" + "".join(filler[half:])
+
+    # 按随机大小切成多个 push 块，与真实页面一样块边界可能落在对象中间
+    chunks, pos = [], 0
+    while pos < len(flight):
+        size = rng.randint(2048, 32768)
+        chunks.append(flight[pos:pos + size])
+        pos += size
+    scripts = "".join(f'<script>self.__next_f.push([1,{json.dumps(chunk)}])</script>' for chunk in chunks)
+    return f"<!DOCTYPE html><html><head><title>LMArena</title></head><body><div id=\"__next\"></div>{scripts}</body></html>"
+
+
+def bench(name: str, extract, html: str, repeat: int):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = extract(html)
+        best = min(best, time.perf_counter() - start)
+    print(f"[{name:<8}] {len(result or [])} 个模型, 最快 {best * 1000:.1f} ms")
+    return best, result
+
+
+def run(label: str, html: str, repeat: int):
+    print(f"--- {label} ({len(html) / 1024 / 1024:.2f} MB) ---")
+    legacy_time, legacy_models = bench("legacy", extract_models_legacy, html, repeat)
+    new_time, new_models = bench("flight", extract_models_from_html, html, repeat)
+    if legacy_models and new_models:
+        legacy_names = {m.get("publicName") for m in legacy_models}
+        new_names = {m.get("publicName") for m in new_models}
+        if legacy_names != new_names:
+            print(f"⚠️ 提取结果不一致: 仅旧实现 {len(legacy_names - new_names)} 个, 仅新实现 {len(new_names - legacy_names)} 个")
+    print(f"加速比: {legacy_time / new_time:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型提取基准")
+    parser.add_argument("--snapshot", nargs="*", help="保存的 LMArena 页面 HTML 文件")
+    parser.add_argument("--filler-mb", type=float, default=2.0, help="合成页面中无关数据的大小 (MB)")
+    parser.add_argument("--repeat", type=int, default=3, help="每种实现运行的次数（取最快值）")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        for path in args.snapshot:
+            with open(path, encoding="utf-8") as f:
+                run(path, f.read(), args.repeat)
+        return
+
+    with open(os.path.join(ROOT, "available_models.json"), encoding="utf-8") as f:
+        models = json.load(f)
+    run("合成页面", make_page(models, args.filler_mb), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# benchmarks/bench_sse_encoder.py
+# SSE 块编码微基准：比较 format_openai_chunk 与按流预渲染的 OpenAIChunkEncoder
+# 每秒可编码的块数。
+#
+# 用法:
+#   python benchmarks/bench_sse_encoder.py
+#   python benchmarks/bench_sse_encoder.py --chunks 500000
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_server import OpenAIChunkEncoder, format_openai_chunk
+
+
+def make_deltas(count: int, seed: int = 0) -> list[str]:
+    """生成与真实流相近的短增量：英文词、中文、引号和换行混合。"""
+    rng = random.Random(seed)
+    samples = [" the", " model", "你好", "，", " \"quoted\"", "\n", " token", "🎉", " code`", "\\path"]
+    return [rng.choice(samples) for _ in range(count)]
+
+
+def bench(name: str, encode, deltas: list[str]):
+    start = time.perf_counter()
+    for delta in deltas:
+        encode(delta)
+    elapsed = time.perf_counter() - start
+    rate = len(deltas) / elapsed
+    print(f"[{name:<20}] {len(deltas)} 块, {elapsed * 1000:.1f} ms, {rate:,.0f} 块/秒")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 块编码微基准")
+    parser.add_argument("--chunks", type=int, default=200_000, help="编码的块数")
+    args = parser.parse_args()
+
+    model = "claude-3-5-sonnet-20241022"
+    response_id = "chatcmpl-00000000-0000-0000-0000-000000000000"
+    deltas = make_deltas(args.chunks)
+
+    encoder = OpenAIChunkEncoder(model, response_id)
+    # 先确认两种实现的输出一致（忽略 created 可能跨秒的差异）
+    assert encoder.chunk("check") == format_openai_chunk("check", model, response_id).replace(
+        f'"created":{int(time.time())}', f'"created":{encoder.created}')
+
+    baseline = bench("format_openai_chunk", lambda d: format_openai_chunk(d, model, response_id), deltas)
+    optimized = bench("OpenAIChunkEncoder", encoder.chunk, deltas)
+    print(f"加速比: {optimized / baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
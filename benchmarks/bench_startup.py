@@ -0,0 +1,77 @@
+# benchmarks/bench_startup.py
+# 启动耗时基准：从启动进程到 /v1/models 首次返回 200 所经过的时间。
+#
+# 每轮启动一个新的服务器进程（默认 `python main.py api_server`），以固定间隔轮询
+# /v1/models，记录首次成功响应的耗时后结束进程。更新检查、模型映射加载等启动步骤
+# 若阻塞了事件循环，会直接体现在这个数字上。
+#
+# 注意：服务器监听固定端口 5102，运行前请先关闭正在运行的实例。
+#
+# 用法:
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --repeat 10
+#   python benchmarks/bench_startup.py --entry api_server.py
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_URL = "http://127.0.0.1:5102/v1/models"
+
+
+def wait_for_models(process: subprocess.Popen, start: float, timeout: float, interval: float) -> float:
+    """轮询直到 /v1/models 返回 200，返回从启动进程起经过的秒数。"""
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"服务器进程已退出 (退出码 {process.returncode})")
+        try:
+            with urllib.request.urlopen(MODELS_URL, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(interval)
+    raise TimeoutError(f"{timeout:.0f} 秒内 /v1/models 未返回 200")
+
+
+def run_once(entry: list[str], timeout: float, interval: float, show_output: bool) -> float:
+    start = time.perf_counter()
+    output = None if show_output else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, *entry], cwd=ROOT, stdout=output, stderr=output)
+    try:
+        return wait_for_models(process, start, timeout, interval)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务器启动耗时基准")
+    parser.add_argument("--entry", nargs="+", default=["main.py", "api_server"], help="启动命令（相对于仓库根目录）")
+    parser.add_argument("--repeat", type=int, default=5, help="启动次数")
+    parser.add_argument("--timeout", type=float, default=90.0, help="单次启动的最长等待时间（秒）")
+    parser.add_argument("--interval", type=float, default=0.02, help="轮询间隔（秒）")
+    parser.add_argument("--show-output", action="store_true", help="显示服务器日志")
+    args = parser.parse_args()
+
+    samples = []
+    for i in range(args.repeat):
+        elapsed = run_once(args.entry, args.timeout, args.interval, args.show_output)
+        samples.append(elapsed)
+        print(f"[{i + 1}/{args.repeat}] 首个 /v1/models 200: {elapsed * 1000:.0f} ms")
+
+    print(f"最快 {min(samples) * 1000:.0f} ms, 中位数 {statistics.median(samples) * 1000:.0f} ms, 最慢 {max(samples) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
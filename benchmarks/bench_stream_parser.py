@@ -0,0 +1,123 @@
+# benchmarks/bench_stream_parser.py
+# 流式响应解析器基准测试：回放（录制的或合成的）多 MB 级 LMArena 流，
+# 验证每个数据块的解析耗时不随已接收内容的增长而上升。
+#
+# 用法:
+#   python benchmarks/bench_stream_parser.py                  # 合成 4MB 流
+#   python benchmarks/bench_stream_parser.py --size-mb 16
+#   python benchmarks/bench_stream_parser.py --replay dump1.txt dump2.txt
+#   python benchmarks/bench_stream_parser.py --legacy          # 同时运行旧的正则实现做对比
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.stream_parser import LMArenaStreamParser
+
+
+def make_stream(size_mb: float, seed: int = 0) -> str:
+    """合成一个与 LMArena 格式一致的流：大量 a0 文本行，末尾是 ad 结束行。"""
+    rng = random.Random(seed)
+    words = ["the", "model", "stream", "token", "中文", "内容", "\"quoted\"", "line\\n", "emoji 🎉", "x" * 12]
+    target = int(size_mb * 1024 * 1024)
+    lines = ['f:{"messageId":"00000000-0000-0000-0000-000000000000"}\n']
+    total = len(lines[0])
+    while total < target:
+        token = " ".join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        line = f"a0:{json.dumps(token, ensure_ascii=False)}\n"
+        lines.append(line)
+        total += len(line)
+    lines.append('ad:{"finishReason":"stop"}\n')
+    return "".join(lines)
+
+
+def split_chunks(stream: str, seed: int = 0) -> list[str]:
+    """按随机大小切分（模拟 reader.read() 的块边界，不与行边界对齐）。"""
+    rng = random.Random(seed)
+    chunks, pos = [], 0
+    while pos < len(stream):
+        size = rng.randint(32, 512)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def run_incremental(chunks: list[str]) -> tuple[list[float], int]:
+    parser = LMArenaStreamParser()
+    timings, events = [], 0
+    for chunk in chunks:
+        start = time.perf_counter()
+        events += len(parser.feed(chunk))
+        timings.append(time.perf_counter() - start)
+    events += len(parser.flush())
+    return timings, events
+
+
+def run_legacy(chunks: list[str]) -> tuple[list[float], int]:
+    """旧实现：每次都把数据追加到缓冲区，并对整个剩余缓冲区重新运行所有正则。"""
+    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
+    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
+    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
+    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
+    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+    buffer, timings, events = "", [], 0
+    for chunk in chunks:
+        start = time.perf_counter()
+        buffer += chunk
+        any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns)
+        error_pattern.search(buffer)
+        while (match := text_pattern.search(buffer)):
+            json.loads(f'"{match.group(1)}"')
+            events += 1
+            buffer = buffer[match.end():]
+        while (match := image_pattern.search(buffer)):
+            buffer = buffer[match.end():]
+        if (match := finish_pattern.search(buffer)):
+            events += 1
+            buffer = buffer[match.end():]
+        timings.append(time.perf_counter() - start)
+    return timings, events
+
+
+def report(name: str, timings: list[float], events: int, total_chars: int):
+    n = len(timings)
+    decile = max(1, n // 10)
+    first = sum(timings[:decile]) / decile * 1e6
+    last = sum(timings[-decile:]) / decile * 1e6
+    total = sum(timings)
+    print(f"[{name}] 块数: {n}, 事件数: {events}, 总耗时: {total * 1000:.1f} ms, "
+          f"吞吐: {total_chars / total / 1024 / 1024:.1f} MB/s")
+    print(f"    前 10% 块平均: {first:.2f} µs/块, 后 10% 块平均: {last:.2f} µs/块, 比值: {last / first:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LMArena 流解析器基准测试")
+    parser.add_argument("--size-mb", type=float, default=4.0, help="合成流的大小 (MB)")
+    parser.add_argument("--replay", nargs="*", help="回放录制的原始流文件")
+    parser.add_argument("--legacy", action="store_true", help="同时运行旧的正则实现")
+    args = parser.parse_args()
+
+    if args.replay:
+        streams = []
+        for path in args.replay:
+            with open(path, 'r', encoding='utf-8') as f:
+                streams.append((path, f.read()))
+    else:
+        streams = [(f"synthetic-{args.size_mb}MB", make_stream(args.size_mb))]
+
+    for name, stream in streams:
+        chunks = split_chunks(stream)
+        print(f"=== {name}: {len(stream) / 1024 / 1024:.2f} MB ===")
+        report("incremental", *run_incremental(chunks), len(stream))
+        if args.legacy:
+            report("legacy", *run_legacy(chunks), len(stream))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 # file_bed_server/main.py
 import base64
+import hashlib
+import heapq
 import os
+import threading
 import uuid
 import time
-from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
@@ -20,38 +23,94 @@ logger = logging.getLogger(__name__)
 # 将上传目录定位到 main.py 文件的同级目录
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+TEMP_DIR = os.path.join(UPLOAD_DIR, "tmp") # 上传中的临时文件，与上传目录在同一文件系统以便原子重命名
 API_KEY = "123456"  # 简单的认证密钥
 CLEANUP_INTERVAL_MINUTES = 1 # 清理任务运行频率（分钟）
 FILE_MAX_AGE_MINUTES = 10 # 文件最大保留时间（分钟）
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024 # 流式上传的单文件大小上限（字节）
+WRITE_CHUNK_BYTES = 256 * 1024 # 流式上传时累积到此大小后才写一次磁盘
+
+# --- 过期索引 ---
+# 文件按过期时间放入最小堆，清理任务只处理堆顶已到期的文件，无需扫描整个目录。
+# _expires_at 记录每个文件当前的过期时间；堆中与之不一致的条目视为已失效（惰性删除）。
+# 上传在线程池中登记，清理在调度器线程中运行，因此用锁保护；
+# 去重命中的判断与清理的删除也在同一把锁下进行，保证返回的文件名不会在随后被删掉。
+_expiry_heap: list[tuple[float, str]] = []
+_expires_at: dict[str, float] = {}
+_expiry_lock = threading.Lock()
+
+# --- 去重统计 ---
+_upload_stats = {"uploads": 0, "dedup_hits": 0, "bytes_saved": 0}
+
+def _shard_path(filename: str) -> str:
+    """按文件名前两位分到子目录，避免单个目录中文件过多。返回相对于 UPLOAD_DIR 的路径。"""
+    return f"{filename[:2]}/{filename}"
+
+def _track_locked(rel_path: str, expires_at: float = None):
+    if expires_at is None:
+        expires_at = time.time() + FILE_MAX_AGE_MINUTES * 60
+    _expires_at[rel_path] = expires_at
+    heapq.heappush(_expiry_heap, (expires_at, rel_path))
+
+def track_file(rel_path: str, expires_at: float = None):
+    """登记（或更新）文件的过期时间。"""
+    with _expiry_lock:
+        _track_locked(rel_path, expires_at)
+
+def _untrack_locked(rel_path: str):
+    """移除文件的过期记录；堆中对应的条目随之失效，失效条目过多时压缩堆。"""
+    if _expires_at.pop(rel_path, None) is None:
+        return
+    if len(_expiry_heap) > 2 * len(_expires_at) + 64:
+        _expiry_heap[:] = [(expires_at, path) for path, expires_at in _expires_at.items()]
+        heapq.heapify(_expiry_heap)
+
+def untrack_file(rel_path: str):
+    with _expiry_lock:
+        _untrack_locked(rel_path)
+
+def rebuild_expiry_index():
+    """启动时扫描一次上传目录（包括旧版未分片的文件和残留的临时文件），重建过期索引。"""
+    max_age = FILE_MAX_AGE_MINUTES * 60
+    entries = []
+    for root, _, files in os.walk(UPLOAD_DIR):
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            try:
+                expires_at = os.path.getmtime(file_path) + max_age
+            except OSError:
+                continue
+            entries.append((expires_at, os.path.relpath(file_path, UPLOAD_DIR).replace(os.sep, '/')))
+    heapq.heapify(entries)
+    with _expiry_lock:
+        _expiry_heap[:] = entries
+        _expires_at.clear()
+        _expires_at.update((rel_path, expires_at) for expires_at, rel_path in entries)
+    logger.info(f"过期索引已重建，共 {len(entries)} 个文件。")
 
 # --- 清理函数 ---
 def cleanup_old_files():
-    """遍历上传目录并删除超过指定时间的文件。"""
+    """删除过期索引中已到期的文件。"""
     now = time.time()
-    cutoff = now - (FILE_MAX_AGE_MINUTES * 60)
-    
-    logger.info(f"正在运行清理任务，删除早于 {datetime.fromtimestamp(cutoff).strftime('%Y-%m-%d %H:%M:%S')} 的文件...")
-    
     deleted_count = 0
-    try:
-        for filename in os.listdir(UPLOAD_DIR):
-            file_path = os.path.join(UPLOAD_DIR, filename)
-            if os.path.isfile(file_path):
-                try:
-                    file_mtime = os.path.getmtime(file_path)
-                    if file_mtime < cutoff:
-                        os.remove(file_path)
-                        logger.info(f"已删除过期文件: {filename}")
-                        deleted_count += 1
-                except OSError as e:
-                    logger.error(f"删除文件 '{file_path}' 时出错: {e}")
-    except Exception as e:
-        logger.error(f"清理旧文件时发生未知错误: {e}", exc_info=True)
+    with _expiry_lock:
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            expires_at, rel_path = heapq.heappop(_expiry_heap)
+            if _expires_at.get(rel_path) != expires_at:
+                continue # 过期时间已被延长，这是失效的旧条目
+            del _expires_at[rel_path]
+            file_path = os.path.join(UPLOAD_DIR, rel_path)
+            try:
+                os.remove(file_path)
+                logger.info(f"已删除过期文件: {rel_path}")
+                deleted_count += 1
+            except FileNotFoundError:
+                pass # 例如上传失败时临时文件已被删除
+            except OSError as e:
+                logger.error(f"删除文件 '{file_path}' 时出错: {e}")
 
     if deleted_count > 0:
         logger.info(f"清理任务完成，共删除了 {deleted_count} 个文件。")
-    else:
-        logger.info("清理任务完成，没有找到需要删除的文件。")
 
 
 # --- FastAPI 生命周期事件 ---
@@ -60,7 +119,8 @@ scheduler = BackgroundScheduler(timezone="UTC")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在服务器启动时启动后台任务，在关闭时停止。"""
-    # 启动调度器并添加任务
+    # 从磁盘重建过期索引，然后启动调度器并添加任务
+    rebuild_expiry_index()
     scheduler.add_job(cleanup_old_files, 'interval', minutes=CLEANUP_INTERVAL_MINUTES)
     scheduler.start()
     logger.info(f"后台文件清理任务已启动，每 {CLEANUP_INTERVAL_MINUTES} 分钟运行一次。")
@@ -76,6 +136,7 @@ app = FastAPI(lifespan=lifespan)
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
     logger.info(f"上传目录 '{UPLOAD_DIR}' 已创建。")
+os.makedirs(TEMP_DIR, exist_ok=True)
 
 # --- 挂载静态文件目录以提供文件访问 ---
 app.mount(f"/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
@@ -86,6 +147,75 @@ class UploadRequest(BaseModel):
     file_data: str # 接收完整的 base64 data URI
     api_key: str | None = None
 
+# --- 辅助函数 ---
+def _guess_extension(file_name: str, mime_type: str) -> str:
+    """优先使用原始文件名的扩展名，否则根据 mime 类型猜测。"""
+    file_extension = os.path.splitext(file_name)[1]
+    if not file_extension:
+        import mimetypes
+        guessed_extension = mimetypes.guess_extension(mime_type) if mime_type else None
+        file_extension = guessed_extension if guessed_extension else '.bin'
+    return file_extension
+
+def _temp_rel_path(temp_path: str) -> str:
+    return f"tmp/{os.path.basename(temp_path)}"
+
+def _new_temp_file():
+    """在临时目录中创建一个上传用的临时文件，返回 (路径, 文件对象)。"""
+    temp_name = f"{uuid.uuid4()}.part"
+    f = open(os.path.join(TEMP_DIR, temp_name), "wb")
+    track_file(f"tmp/{temp_name}") # 进程在上传中途退出时残留的临时文件也会被清理
+    return f.name, f
+
+def _discard_temp_file(temp_path: str):
+    """上传失败时删除临时文件并移除其过期记录。"""
+    _remove_quietly(temp_path)
+    untrack_file(_temp_rel_path(temp_path))
+
+def _write_chunk(f, hasher, data):
+    f.write(data)
+    hasher.update(data)
+
+def _commit_upload(temp_path: str, digest: str, file_extension: str, size: int) -> tuple[str, bool]:
+    """
+    把写完的临时文件按内容哈希存入分片目录。
+    内容已存在时丢弃临时文件并延长已有文件的过期时间。
+    :return: (相对文件名, 是否命中去重)
+    """
+    rel_path = _shard_path(f"{digest}{file_extension}")
+    file_path = os.path.join(UPLOAD_DIR, rel_path)
+    with _expiry_lock:
+        _untrack_locked(_temp_rel_path(temp_path)) # 临时文件随后被重命名或删除
+        _upload_stats["uploads"] += 1
+        if rel_path in _expires_at and os.path.exists(file_path):
+            os.remove(temp_path)
+            os.utime(file_path) # 同步更新 mtime，重启后重建的索引也能保留延长后的过期时间
+            _track_locked(rel_path)
+            _upload_stats["dedup_hits"] += 1
+            _upload_stats["bytes_saved"] += size
+            return rel_path, True
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(temp_path, file_path)
+        _track_locked(rel_path)
+        return rel_path, False
+
+def _store_bytes(data: bytes, file_extension: str) -> tuple[str, bool]:
+    """把一次性收到的完整内容写入存储（在线程池中调用）。"""
+    temp_path, f = _new_temp_file()
+    try:
+        with f:
+            f.write(data)
+        return _commit_upload(temp_path, hashlib.sha256(data).hexdigest(), file_extension, len(data))
+    except BaseException:
+        _discard_temp_file(temp_path)
+        raise
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 # --- API 端点 ---
 @app.post("/upload")
 async def upload_file(request: UploadRequest, http_request: Request):
@@ -103,24 +233,17 @@ async def upload_file(request: UploadRequest, http_request: Request):
         # 2. 解码 base64 数据
         file_data = base64.b64decode(encoded_data)
         
-        # 3. 生成唯一文件名以避免冲突
-        file_extension = os.path.splitext(request.file_name)[1]
-        if not file_extension:
-            # 尝试从 header 中获取 mime 类型来猜测扩展名
-            import mimetypes
-            mime_type = header.split(';')[0].split(':')[1]
-            guessed_extension = mimetypes.guess_extension(mime_type)
-            file_extension = guessed_extension if guessed_extension else '.bin'
-
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-        # 4. 保存文件
-        with open(file_path, "wb") as f:
-            f.write(file_data)
+        # 3. 确定扩展名（尝试从 header 中获取 mime 类型来猜测扩展名）
+        file_extension = _guess_extension(request.file_name, header.split(';')[0].split(':')[1])
+
+        # 4. 按内容哈希保存文件（在线程池中写盘，避免阻塞事件循环）；相同内容只保存一份
+        unique_filename, deduplicated = await run_in_threadpool(_store_bytes, file_data, file_extension)
         
-        # 5. 返回成功信息和唯一文件名
-        logger.info(f"文件 '{request.file_name}' 已成功保存为 '{unique_filename}'。")
+        # 5. 返回成功信息和文件名
+        if deduplicated:
+            logger.info(f"文件 '{request.file_name}' 与已有文件 '{unique_filename}' 内容相同，已延长其保留时间。")
+        else:
+            logger.info(f"文件 '{request.file_name}' 已成功保存为 '{unique_filename}'。")
         
         return JSONResponse(
             status_code=200,
@@ -134,6 +257,63 @@ async def upload_file(request: UploadRequest, http_request: Request):
         logger.error(f"处理文件上传时发生未知错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"内部服务器错误: {e}")
 
+@app.post("/upload/stream")
+async def upload_file_stream(http_request: Request, file_name: str = "", x_api_key: str | None = Header(None)):
+    """
+    接收原始字节流形式的文件（请求体即文件内容，Content-Type 为其 mime 类型），
+    边接收边写入磁盘，返回与 /upload 相同格式的结果。
+    相比 base64 JSON 上传，省去了约 33% 的编码膨胀和多份完整的内存拷贝。
+    """
+    if API_KEY and x_api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="无效的 API Key")
+
+    mime_type = http_request.headers.get("content-type", "").split(';')[0].strip()
+    file_extension = _guess_extension(file_name, mime_type)
+    # 先写入临时文件并同时计算内容哈希，完成后再原子地重命名为哈希文件名，
+    # 静态文件服务不会读到写了一半的文件
+    temp_path, f = await run_in_threadpool(_new_temp_file)
+    hasher = hashlib.sha256()
+    try:
+        size = 0
+        buffer = bytearray()
+        async for chunk in http_request.stream():
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"文件超过大小上限 ({MAX_UPLOAD_BYTES} 字节)")
+            buffer += chunk
+            if len(buffer) >= WRITE_CHUNK_BYTES:
+                await run_in_threadpool(_write_chunk, f, hasher, buffer)
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(_write_chunk, f, hasher, buffer)
+        await run_in_threadpool(f.close)
+        unique_filename, deduplicated = await run_in_threadpool(_commit_upload, temp_path, hasher.hexdigest(), file_extension, size)
+    except BaseException as e:
+        f.close()
+        _discard_temp_file(temp_path)
+        if isinstance(e, Exception) and not isinstance(e, HTTPException):
+            logger.error(f"处理流式上传时发生未知错误: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"内部服务器错误: {e}")
+        raise
+
+    if deduplicated:
+        logger.info(f"文件 '{file_name}' 与已有文件 '{unique_filename}' 内容相同，已延长其保留时间。")
+    else:
+        logger.info(f"文件 '{file_name}' 已通过流式上传保存为 '{unique_filename}' ({size} 字节)。")
+    return JSONResponse(
+        status_code=200,
+        content={"success": True, "filename": unique_filename}
+    )
+
+@app.get("/stats")
+def upload_stats():
+    """返回上传去重命中率及当前保留的文件数。"""
+    with _expiry_lock:
+        stats = dict(_upload_stats)
+        stats["tracked_files"] = len(_expires_at)
+    stats["dedup_hit_ratio"] = round(stats["dedup_hits"] / stats["uploads"], 3) if stats["uploads"] else 0.0
+    return stats
+
 @app.get("/")
 def read_root():
     return {"message": "LMArena Bridge 文件床服务器正在运行。"}
@@ -144,5 +324,6 @@ if __name__ == "__main__":
     logger.info("🚀 文件床服务器正在启动...")
     logger.info("   - 监听地址: http://127.0.0.1:5180")
     logger.info(f"   - 上传端点: http://127.0.0.1:5180/upload")
+    logger.info(f"   - 流式上传端点: http://127.0.0.1:5180/upload/stream")
     logger.info(f"   - 文件访问路径: /uploads")
     uvicorn.run(app, host="0.0.0.0", port=5180)
\ No newline at end of file
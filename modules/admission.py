@@ -0,0 +1,196 @@
+# modules/admission.py
+# 请求准入控制：限制每个浏览器标签页和每个会话的并发数，超出部分进入有界排队
+
+import asyncio
+import bisect
+import itertools
+import logging
+import math
+import time
+from typing import Optional
+
+from modules.browser_pool import BrowserWorker, BrowserWorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（队列已满或排队超时），调用方应返回 429。"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("key", "request_id", "session_id", "future", "enqueued_at")
+
+    def __init__(self, key: tuple, request_id: str, session_id: Optional[str], future: asyncio.Future):
+        self.key = key
+        self.request_id = request_id
+        self.session_id = session_id
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.key < other.key
+
+
+class AdmissionController:
+    """
+    在请求分派到浏览器之前执行准入控制。
+
+    - 每个标签页最多 max_per_worker 个在途请求，每个 session_id 最多 max_per_session 个（0 表示不限）。
+    - 没有空闲容量时请求进入按优先级排序（同优先级先进先出）的有界队列。
+    - 队列已满或排队超过 queue_timeout 秒时抛出 AdmissionRejected。
+    - 准入成功时直接把请求分配给负载最低的标签页，避免并发准入时超额分配。
+    """
+
+    def __init__(self, pool: BrowserWorkerPool):
+        self.pool = pool
+        self.max_per_worker = 6
+        self.max_per_session = 0
+        self.queue_size = 100
+        self.queue_timeout = 60.0
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._session_in_flight: dict[str, int] = {}
+        self._request_session: dict[str, Optional[str]] = {}
+        self._admitted_at: dict[str, float] = {}
+        # --- 统计 ---
+        self.admitted_total = 0
+        self.queued_total = 0
+        self.rejected_total = 0
+        self.timed_out_total = 0
+        self.waited_total = 0  # 经过排队后被准入的请求数
+        self.wait_seconds_sum = 0.0
+        self.wait_seconds_max = 0.0
+        self._avg_hold_seconds = 0.0  # 请求占用槽位时长的指数移动平均
+
+    def configure(self, config: dict):
+        """从配置快照更新限制值（支持热重载）。"""
+        self.max_per_worker = config.get("max_concurrent_requests_per_tab", 6)
+        self.max_per_session = config.get("max_concurrent_requests_per_session", 0)
+        self.queue_size = config.get("admission_queue_size", 100)
+        self.queue_timeout = config.get("admission_queue_timeout_seconds", 60)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(min(self.queue_timeout, self._avg_hold_seconds or 1.0)))
+
+    def _session_has_capacity(self, session_id: Optional[str]) -> bool:
+        if not self.max_per_session or not session_id:
+            return True
+        return self._session_in_flight.get(session_id, 0) < self.max_per_session
+
+    def _pick_worker(self) -> Optional[BrowserWorker]:
+        worker = self.pool.pick()
+        if worker and (not self.max_per_worker or worker.load < self.max_per_worker):
+            return worker
+        return None
+
+    def _grant(self, request_id: str, session_id: Optional[str], worker: BrowserWorker):
+        self.pool.assign(request_id, worker)
+        if session_id:
+            self._session_in_flight[session_id] = self._session_in_flight.get(session_id, 0) + 1
+        self._request_session[request_id] = session_id
+        self._admitted_at[request_id] = time.monotonic()
+        self.admitted_total += 1
+
+    async def acquire(self, request_id: str, session_id: Optional[str], priority: int = 0) -> BrowserWorker:
+        """
+        为请求申请一个浏览器槽位，返回已分配的标签页。
+        :param priority: 数值越大越优先，同优先级按到达顺序。
+        :raises AdmissionRejected: 队列已满或排队超时。
+        """
+        # 只有在没有人排队时才允许直接准入，保证排队请求不被后来者插队
+        if not self._waiters and self._session_has_capacity(session_id):
+            worker = self._pick_worker()
+            if worker:
+                self._grant(request_id, session_id, worker)
+                return worker
+
+        if self.queue_size >= 0 and len(self._waiters) >= self.queue_size:
+            self.rejected_total += 1
+            raise AdmissionRejected(f"服务器繁忙，排队请求已达上限 ({self.queue_size})。", self._retry_after())
+
+        waiter = _Waiter((-priority, next(self._seq)), request_id, session_id, asyncio.get_running_loop().create_future())
+        bisect.insort(self._waiters, waiter)
+        self.queued_total += 1
+        logger.info(f"ADMISSION [ID: {request_id[:8]}]: 无空闲容量，进入排队 (队列深度: {len(self._waiters)})。")
+        try:
+            worker = await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            granted = waiter.future.done() and not waiter.future.cancelled()
+            if isinstance(e, asyncio.TimeoutError) and granted:
+                # 超时与准入同时发生：按准入处理
+                worker = waiter.future.result()
+            elif granted:
+                # 已被准入但调用方已放弃（例如客户端断开），归还槽位
+                self.release(request_id)
+                raise
+            else:
+                waiter.future.cancel()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.timed_out_total += 1
+                raise AdmissionRejected(f"排队等待超过 {self.queue_timeout} 秒，请稍后重试。", self._retry_after()) from None
+        wait = time.monotonic() - waiter.enqueued_at
+        self.waited_total += 1
+        self.wait_seconds_sum += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+        return worker
+
+    def release(self, request_id: str):
+        """请求结束后释放其槽位并唤醒排队者。可重复调用。"""
+        self.pool.release(request_id)
+        if request_id in self._request_session:
+            session_id = self._request_session.pop(request_id)
+            if session_id and session_id in self._session_in_flight:
+                self._session_in_flight[session_id] -= 1
+                if self._session_in_flight[session_id] <= 0:
+                    del self._session_in_flight[session_id]
+            admitted_at = self._admitted_at.pop(request_id, None)
+            if admitted_at is not None:
+                hold = time.monotonic() - admitted_at
+                self._avg_hold_seconds = hold if not self._avg_hold_seconds else 0.8 * self._avg_hold_seconds + 0.2 * hold
+        self.wake()
+
+    def wake(self):
+        """把空闲容量按优先级分配给排队者；会话已满的排队者会被跳过，避免队头阻塞。"""
+        for waiter in list(self._waiters):
+            if waiter.future.done():
+                self._waiters.remove(waiter)
+                continue
+            if not self._session_has_capacity(waiter.session_id):
+                continue
+            worker = self._pick_worker()
+            if not worker:
+                break
+            self._waiters.remove(waiter)
+            self._grant(waiter.request_id, waiter.session_id, worker)
+            waiter.future.set_result(worker)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "admitted_total": self.admitted_total,
+            "queued_total": self.queued_total,
+            "rejected_total": self.rejected_total,
+            "timed_out_total": self.timed_out_total,
+            "waited_total": self.waited_total,
+            "wait_seconds_sum": round(self.wait_seconds_sum, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "in_flight_by_session": {sid[-6:]: n for sid, n in self._session_in_flight.items()},
+            "limits": {
+                "max_per_worker": self.max_per_worker,
+                "max_per_session": self.max_per_session,
+                "queue_size": self.queue_size,
+                "queue_timeout_seconds": self.queue_timeout,
+            },
+        }
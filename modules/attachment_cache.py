@@ -0,0 +1,79 @@
+# modules/attachment_cache.py
+# 以内容哈希为键的文件床上传结果缓存
+#
+# 聊天客户端每一轮都会重发完整历史，同一张图片会在一次对话中被反复上传。
+# 这里以解码后字节的 SHA-256 为键缓存文件床返回的文件名，重复的附件直接复用。
+
+import base64
+import binascii
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def content_key(data_uri: str) -> Optional[str]:
+    """计算 data URI 中解码后内容的 SHA-256；格式无效时返回 None。"""
+    header, sep, encoded = data_uri.partition(',')
+    if not sep or not header.endswith(';base64'):
+        return None
+    try:
+        decoded = base64.b64decode(encoded)
+    except (binascii.Error, ValueError):
+        return None
+    return hashlib.sha256(decoded).hexdigest()
+
+
+class AttachmentCache:
+    """
+    内容哈希 -> 文件床文件名 的 TTL 缓存。
+
+    文件床会删除上传超过 FILE_MAX_AGE_MINUTES（默认 10 分钟）的文件，
+    因此条目的有效期从上传时刻起算、命中时不续期，且 ttl 应小于文件床的保留时间，
+    为 LMArena 实际拉取图片留出余量。
+    """
+
+    def __init__(self, ttl_seconds: float = 480, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, tuple[str, float]] = OrderedDict()  # (upload_url, 哈希) -> (文件名, 过期时间)
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config: dict):
+        """从配置快照更新有效期（支持热重载）。"""
+        self.ttl_seconds = config.get("file_bed_cache_ttl_seconds", 480)
+
+    def get(self, upload_url: str, key: str) -> Optional[str]:
+        entry = self._entries.get((upload_url, key))
+        if entry is not None:
+            filename, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end((upload_url, key))
+                self.hits += 1
+                return filename
+            del self._entries[(upload_url, key)]
+        self.misses += 1
+        return None
+
+    def put(self, upload_url: str, key: str, filename: str):
+        if self.ttl_seconds <= 0:
+            return
+        now = time.monotonic()
+        self._entries[(upload_url, key)] = (filename, now + self.ttl_seconds)
+        self._entries.move_to_end((upload_url, key))
+        # 先清掉已过期的条目，再按最近使用顺序淘汰超出容量的部分
+        for cache_key in [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[cache_key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "ttl_seconds": self.ttl_seconds,
+        }
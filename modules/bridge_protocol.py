@@ -0,0 +1,60 @@
+# modules/bridge_protocol.py
+# 服务器与油猴脚本之间的紧凑二进制帧协议 (协议版本 2)
+#
+# 握手:
+#   脚本连接后发送 JSON 文本 {"type": "hello", "protocol": 2}，
+#   服务器回复 {"type": "hello_ack", "protocol": 2} 后，双方对流数据改用二进制帧。
+#   未发送 hello 的旧脚本继续使用 JSON 文本协议 (协议版本 1)。
+#
+# 二进制帧格式 (大端序)，一个 WebSocket 消息可以包含多个连续的帧:
+#   +--------+----------------+----------------+-------------------+
+#   | type   | stream_id      | length         | payload (UTF-8)   |
+#   | 1 字节 | 4 字节 uint32   | 4 字节 uint32   | length 字节        |
+#   +--------+----------------+----------------+-------------------+
+# stream_id 是服务器分派请求时分配的短整数 ID，代替每帧重复的 36 字符 UUID；
+# 与具体请求无关的帧 (例如 id_update、全局指令) 使用 stream_id 0。
+
+import struct
+from typing import Iterator, Union
+
+PROTOCOL_VERSION = 2
+
+FRAME_DATA = 1       # 脚本 -> 服务器: 原始响应文本块
+FRAME_DONE = 2       # 脚本 -> 服务器: 流正常结束 (无 payload)
+FRAME_ERROR = 3      # 脚本 -> 服务器: 错误信息文本
+FRAME_COMMAND = 4    # 服务器 -> 脚本: 针对某个流的指令名 (pause/resume 等)
+FRAME_ID_UPDATE = 5  # 脚本 -> 服务器: JSON 格式的 {session_id, message_id}
+
+FRAME_TYPES = frozenset({FRAME_DATA, FRAME_DONE, FRAME_ERROR, FRAME_COMMAND, FRAME_ID_UPDATE})
+
+_HEADER = struct.Struct('>BII')
+HEADER_SIZE = _HEADER.size
+MAX_STREAM_ID = 0xFFFFFFFF
+
+
+class ProtocolError(ValueError):
+    """二进制帧格式错误。"""
+
+
+def encode_frame(frame_type: int, stream_id: int, payload: Union[str, bytes] = b"") -> bytes:
+    """编码单个帧。"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return _HEADER.pack(frame_type, stream_id, len(payload)) + payload
+
+
+def iter_frames(message: bytes) -> Iterator[tuple[int, int, bytes]]:
+    """依次解出一个 WebSocket 二进制消息中的所有帧: (type, stream_id, payload)。"""
+    view = memoryview(message)
+    offset, total = 0, len(view)
+    while offset < total:
+        if total - offset < HEADER_SIZE:
+            raise ProtocolError(f"帧头不完整: 剩余 {total - offset} 字节")
+        frame_type, stream_id, length = _HEADER.unpack_from(view, offset)
+        offset += HEADER_SIZE
+        if frame_type not in FRAME_TYPES:
+            raise ProtocolError(f"未知的帧类型: {frame_type}")
+        if total - offset < length:
+            raise ProtocolError(f"帧内容不完整: 需要 {length} 字节，剩余 {total - offset} 字节")
+        yield frame_type, stream_id, bytes(view[offset:offset + length])
+        offset += length
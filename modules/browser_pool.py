@@ -0,0 +1,191 @@
+# modules/browser_pool.py
+# 管理多个油猴脚本标签页（浏览器 Worker）的连接池
+
+import logging
+import time
+import uuid
+from typing import Optional
+
+from modules import json_codec
+from modules.bridge_protocol import FRAME_COMMAND, MAX_STREAM_ID, encode_frame
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserWorker:
+    """
+    代表一个已连接的浏览器标签页。
+    每个标签页拥有独立的 WebSocket 连接和独立的在途请求集合。
+    """
+
+    def __init__(self, websocket, worker_id: Optional[str] = None):
+        self.worker_id = worker_id or uuid.uuid4().hex[:8]
+        self.websocket = websocket
+        self.in_flight: set[str] = set()  # 该标签页上正在进行的 request_id
+        self.dispatched = 0  # 累计分派的请求数，用于负载相同时的平局裁决
+        self.healthy = True  # 例如：已被要求刷新以完成人机验证时置为 False
+        self.connected_at = time.time()
+        # 协议版本：1 为 JSON 文本协议；脚本握手成功后升级为 2 (二进制帧协议)
+        self.protocol = 1
+        self._next_stream_id = 1
+        self.streams: dict[int, str] = {}  # stream_id -> request_id
+        self.stream_ids: dict[str, int] = {}  # request_id -> stream_id
+        # --- 流量统计 (WebSocket 消息数与字节数) ---
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    @property
+    def load(self) -> int:
+        """当前在途请求数。"""
+        return len(self.in_flight)
+
+    @property
+    def is_connected(self) -> bool:
+        return self.websocket.client_state.name == 'CONNECTED'
+
+    async def send_json(self, message: dict):
+        """以 JSON 文本帧发送消息。"""
+        text = json_codec.dumps(message)
+        await self.websocket.send_text(text)
+        self.frames_sent += 1
+        self.bytes_sent += len(text)
+
+    async def send_command(self, command: str, request_id: Optional[str] = None):
+        """
+        发送指令。针对某个流的指令在二进制协议下编码为 COMMAND 帧，
+        其余情况使用 JSON 文本，新旧脚本都能识别。
+        """
+        stream_id = self.stream_ids.get(request_id) if request_id else None
+        if self.protocol >= 2 and stream_id is not None:
+            frame = encode_frame(FRAME_COMMAND, stream_id, command)
+            await self.websocket.send_bytes(frame)
+            self.frames_sent += 1
+            self.bytes_sent += len(frame)
+            return
+        message = {"command": command}
+        if request_id:
+            message["request_id"] = request_id
+        await self.send_json(message)
+
+    def record_received(self, size: int):
+        """记录收到的一条 WebSocket 消息。"""
+        self.frames_received += 1
+        self.bytes_received += size
+
+    def open_stream(self, request_id: str) -> int:
+        """为请求分配一个在该连接内唯一的短整数 stream_id。"""
+        stream_id = self._next_stream_id
+        while stream_id in self.streams:
+            stream_id = stream_id % MAX_STREAM_ID + 1
+        self._next_stream_id = stream_id % MAX_STREAM_ID + 1
+        self.streams[stream_id] = request_id
+        self.stream_ids[request_id] = stream_id
+        return stream_id
+
+    def close_stream(self, request_id: str):
+        stream_id = self.stream_ids.pop(request_id, None)
+        if stream_id is not None:
+            self.streams.pop(stream_id, None)
+
+
+class BrowserWorkerPool:
+    """
+    浏览器 Worker 池。
+    - 每个连接到 /ws 的标签页都会注册为一个 Worker。
+    - 请求按“最少在途请求”策略分派到健康的 Worker。
+    - 某个 Worker 断开时，只影响它自己的在途请求。
+    """
+
+    def __init__(self):
+        self.workers: dict[str, BrowserWorker] = {}
+        self._request_owner: dict[str, str] = {}  # request_id -> worker_id
+        # 已断开的 Worker 的流量累计，保证 traffic_totals() 单调递增
+        self._retired_traffic = {"frames_sent": 0, "bytes_sent": 0, "frames_received": 0, "bytes_received": 0}
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    def register(self, websocket) -> BrowserWorker:
+        """注册一个新的标签页连接。"""
+        worker = BrowserWorker(websocket)
+        self.workers[worker.worker_id] = worker
+        logger.info(f"浏览器 Worker [{worker.worker_id}] 已注册。当前 Worker 数: {len(self.workers)}")
+        return worker
+
+    def unregister(self, worker: BrowserWorker) -> set[str]:
+        """
+        注销一个标签页连接。
+        :return: 该 Worker 上仍在途的 request_id 集合，调用方负责让这些请求失败。
+        """
+        if self.workers.pop(worker.worker_id, None) is not None:
+            for key in self._retired_traffic:
+                self._retired_traffic[key] += getattr(worker, key)
+        orphaned = set(worker.in_flight)
+        for request_id in orphaned:
+            self._request_owner.pop(request_id, None)
+        worker.in_flight.clear()
+        worker.streams.clear()
+        worker.stream_ids.clear()
+        logger.info(f"浏览器 Worker [{worker.worker_id}] 已注销，{len(orphaned)} 个在途请求受影响。当前 Worker 数: {len(self.workers)}")
+        return orphaned
+
+    def healthy_workers(self) -> list[BrowserWorker]:
+        return [w for w in self.workers.values() if w.healthy and w.is_connected]
+
+    def has_healthy_worker(self) -> bool:
+        return any(w.healthy and w.is_connected for w in self.workers.values())
+
+    def pick(self) -> Optional[BrowserWorker]:
+        """按最少在途请求选择一个健康的 Worker；负载相同时选择累计分派较少的。"""
+        candidates = self.healthy_workers()
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: (w.load, w.dispatched))
+
+    def any_worker(self) -> Optional[BrowserWorker]:
+        """为指令类消息（如 send_page_source）选择一个 Worker，优先健康的。"""
+        return self.pick() or next((w for w in self.workers.values() if w.is_connected), None)
+
+    def assign(self, request_id: str, worker: BrowserWorker) -> int:
+        """记录请求由哪个 Worker 处理，返回为其分配的 stream_id。"""
+        worker.in_flight.add(request_id)
+        worker.dispatched += 1
+        self._request_owner[request_id] = worker.worker_id
+        return worker.open_stream(request_id)
+
+    def release(self, request_id: str):
+        """请求结束后释放其在 Worker 上的占用。可重复调用。"""
+        worker_id = self._request_owner.pop(request_id, None)
+        if worker_id and (worker := self.workers.get(worker_id)):
+            worker.in_flight.discard(request_id)
+            worker.close_stream(request_id)
+
+    def worker_for(self, request_id: str) -> Optional[BrowserWorker]:
+        """返回正在处理该请求的 Worker。"""
+        worker_id = self._request_owner.get(request_id)
+        return self.workers.get(worker_id) if worker_id else None
+
+    def traffic_totals(self) -> dict:
+        """所有 Worker（包括已断开的）的累计 WebSocket 消息数与字节数。"""
+        totals = dict(self._retired_traffic)
+        for worker in self.workers.values():
+            for key in totals:
+                totals[key] += getattr(worker, key)
+        return totals
+
+    def snapshot(self) -> list[dict]:
+        """用于状态查询的 Worker 概览。"""
+        return [
+            {
+                "worker_id": w.worker_id,
+                "in_flight": w.load,
+                "dispatched": w.dispatched,
+                "healthy": w.healthy,
+                "protocol": w.protocol,
+                "bytes_received": w.bytes_received,
+                "connected_at": int(w.connected_at),
+            }
+            for w in self.workers.values()
+        ]
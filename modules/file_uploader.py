@@ -1,4 +1,5 @@
 # modules/file_uploader.py
+import base64
 import httpx
 import logging
 
@@ -6,9 +7,79 @@ logger = logging.getLogger(__name__)
 
 from typing import Tuple, Optional
 
+# 长期复用的连接池客户端：api_server 首次上传附件时由 _get_file_uploader() 调用 open_client() 创建，
+# 在 lifespan 结束时（仅当已创建）调用 close_client() 关闭。
+# 未初始化时（例如单独调用本模块）每次上传临时创建一个客户端。
+_client: Optional[httpx.AsyncClient] = None
+
+def open_client(max_connections: int = 10) -> httpx.AsyncClient:
+    """创建共享的连接池客户端，之后的上传复用其 TCP/TLS 连接。"""
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=60.0,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+    return _client
+
+# 流式上传时每次解码的 base64 字符数（必须是 4 的倍数），对应约 192KB 的原始字节
+_STREAM_CHUNK_CHARS = 256 * 1024
+# b64decode 会忽略空白字符（例如 MIME 风格的换行）；分块解码前必须先去掉它们，否则块边界会错位
+_BASE64_WHITESPACE = ("\n", "\r", " ", "\t")
+# 不支持 /upload/stream 的旧版文件床地址，之后直接使用 JSON 上传
+_stream_unsupported: set[str] = set()
+
+async def close_client():
+    """关闭共享客户端。"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+async def _post(url: str, **kwargs) -> httpx.Response:
+    """使用共享客户端发送 POST；共享客户端未初始化时临时创建一个。"""
+    if _client is not None:
+        return await _client.post(url, **kwargs)
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        return await client.post(url, **kwargs)
+
+async def _iter_decoded(encoded: str):
+    """分块解码 base64，避免在内存中同时持有完整的解码结果。"""
+    for start in range(0, len(encoded), _STREAM_CHUNK_CHARS):
+        yield base64.b64decode(encoded[start:start + _STREAM_CHUNK_CHARS])
+
+async def _post_stream(upload_url: str, file_name: str, file_data: str, api_key: Optional[str]) -> Optional[httpx.Response]:
+    """
+    以原始字节流上传到文件床的 /upload/stream 端点。
+    :return: 响应；data URI 不是 base64 格式或文件床不支持流式端点时返回 None，由调用方改用 JSON 上传。
+    """
+    stream_url = upload_url.rstrip('/') + "/stream"
+    if stream_url in _stream_unsupported:
+        return None
+    header, sep, encoded = file_data.partition(',')
+    if not sep or not header.startswith("data:") or not header.endswith(";base64"):
+        return None
+    mime_type = header[5:].split(';')[0] or "application/octet-stream"
+    if any(ch in encoded for ch in _BASE64_WHITESPACE):
+        encoded = "".join(encoded.split())
+    if len(encoded) % 4:
+        return None # 填充不完整，交给 JSON 上传（由文件床按原样解码或报错）
+
+    response = await _post(
+        stream_url,
+        params={"file_name": file_name},
+        headers={"Content-Type": mime_type, "X-API-Key": api_key or ""},
+        content=_iter_decoded(encoded),
+    )
+    if response.status_code in (404, 405):
+        logger.info(f"文件床不支持流式上传端点 ({stream_url})，将改用 JSON 上传。")
+        _stream_unsupported.add(stream_url)
+        return None
+    return response
+
 async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, api_key: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
     """
     将 base64 编码的文件上传到文件床服务器。
+    优先以解码后的原始字节流上传到 /upload/stream；旧版文件床回退为 JSON 上传。
 
     :param file_name: 原始文件名。
     :param file_data: Base64 data URI (例如, "data:image/png;base64,...").
@@ -17,26 +88,26 @@ async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, ap
     :return: 一个元组 (filename, error_message)。成功时 filename 是字符串，error_message 是 None；
              失败时 filename 是 None，error_message 是包含错误信息的字符串。
     """
-    payload = {
-        "file_name": file_name,
-        "file_data": file_data,
-        "api_key": api_key
-    }
-    
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(upload_url, json=payload)
-            
-            response.raise_for_status()  # 如果状态码是 4xx 或 5xx，则引发异常
+        response = await _post_stream(upload_url, file_name, file_data, api_key)
+        if response is None:
+            payload = {
+                "file_name": file_name,
+                "file_data": file_data,
+                "api_key": api_key
+            }
+            response = await _post(upload_url, json=payload)
             
-            result = response.json()
-            if result.get("success") and result.get("filename"):
-                logger.info(f"文件 '{file_name}' 成功上传到文件床，文件名为: {result['filename']}")
-                return result["filename"], None
-            else:
-                error_msg = result.get("error", "文件床返回了未知的错误。")
-                logger.error(f"上传到文件床失败: {error_msg}")
-                return None, error_msg
+        response.raise_for_status()  # 如果状态码是 4xx 或 5xx，则引发异常
+        
+        result = response.json()
+        if result.get("success") and result.get("filename"):
+            logger.info(f"文件 '{file_name}' 成功上传到文件床，文件名为: {result['filename']}")
+            return result["filename"], None
+        else:
+            error_msg = result.get("error", "文件床返回了未知的错误。")
+            logger.error(f"上传到文件床失败: {error_msg}")
+            return None, error_msg
                 
     except httpx.HTTPStatusError as e:
         error_details = f"HTTP 错误: {e.response.status_code} - {e.response.text}"
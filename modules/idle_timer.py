@@ -0,0 +1,90 @@
+# modules/idle_timer.py
+# 基于事件循环定时器的空闲检测：没有活动时不轮询，有进行中的响应流时不计为空闲
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class IdleTimer:
+    """
+    在最后一次活动后 timeout 秒、且没有进行中的响应流时调用 on_idle(idle_seconds)。
+
+    touch() 只记录活动时间，不重新设置定时器：定时器到期时若发现期间有过活动，
+    就按新的截止时间重新设置一次。因此每个请求的开销只是一次赋值，
+    两次活动之间没有任何轮询。所有方法都必须在事件循环线程中调用。
+    """
+
+    def __init__(self):
+        self.on_idle: Optional[Callable[[float], Awaitable[None]]] = None
+        self.timeout: Optional[float] = None  # None 表示禁用
+        self.active_streams = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_activity = 0.0
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._idle_task: Optional[asyncio.Task] = None
+
+    def start(self, on_idle: Callable[[float], Awaitable[None]]):
+        """绑定当前事件循环并开始计时（在 lifespan 中调用）。"""
+        self.on_idle = on_idle
+        self._loop = asyncio.get_running_loop()
+        self.touch()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def configure(self, enabled: bool, timeout: float):
+        """更新开关和超时时间（配置热重载后调用）；timeout 为 -1 时禁用。"""
+        new_timeout = timeout if enabled and timeout != -1 else None
+        if new_timeout == self.timeout:
+            return
+        self.timeout = new_timeout
+        self._arm()
+
+    def idle_seconds(self) -> float:
+        return self._loop.time() - self._last_activity if self._loop else 0.0
+
+    def touch(self):
+        """记录一次活动。"""
+        if self._loop is None:
+            return
+        self._last_activity = self._loop.time()
+        if self._handle is None:
+            self._arm()
+
+    def stream_started(self):
+        self.active_streams += 1
+        self.touch()
+
+    def stream_finished(self):
+        self.active_streams -= 1
+        self.touch()
+
+    def _arm(self):
+        self.stop()
+        if self._loop is None or self.timeout is None or self.active_streams > 0:
+            return
+        if self._idle_task is not None and not self._idle_task.done():
+            return
+        self._handle = self._loop.call_at(self._last_activity + self.timeout, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        if self.timeout is None or self.active_streams > 0:
+            # 有响应流进行中：不设置定时器，最后一个流结束时会重新设置
+            return
+        if self._loop.time() < self._last_activity + self.timeout:
+            self._arm()
+            return
+        self._idle_task = self._loop.create_task(self.on_idle(self.idle_seconds()))
+        self._idle_task.add_done_callback(self._idle_done)
+
+    def _idle_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"空闲处理失败: {task.exception()}")
+        # 空闲处理（例如软重启）完成后重新开始计时
+        self.touch()
@@ -0,0 +1,64 @@
+# modules/json_codec.py
+# 可插拔的 JSON 编解码层：安装了 orjson 时使用 orjson，否则回退到标准库 json。
+#
+# 所有热路径（请求体解析、WebSocket 帧解析、流式文本反转义、SSE 块编码、
+# 发往浏览器的载荷序列化）都通过此模块进行。
+# 输出统一为紧凑格式（无多余空格）且不转义非 ASCII 字符，两种后端结果一致。
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖
+    orjson = None
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，调用方只需捕获这一个类型
+JSONDecodeError = json.JSONDecodeError
+
+
+def _std_loads(data: Union[str, bytes]) -> Any:
+    return json.loads(data)
+
+
+def _std_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _ascii_dumps_bytes(obj: Any) -> bytes:
+    # ensure_ascii=True 会把孤立的代理字符转义为 \udxxx，结果总能编码（loads 可接受的输入都能再序列化）
+    return json.dumps(obj, separators=(',', ':')).encode('ascii')
+
+
+def _std_dumps_bytes(obj: Any) -> bytes:
+    try:
+        return _std_dumps(obj).encode('utf-8')
+    except UnicodeEncodeError:
+        return _ascii_dumps_bytes(obj)
+
+
+BACKENDS = {"json": (_std_loads, _std_dumps, _std_dumps_bytes)}
+
+if orjson is not None:
+    def _orjson_loads(data: Union[str, bytes]) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson 比标准库更严格（例如拒绝孤立的代理字符），交给标准库做最终判断
+            return json.loads(data)
+
+    def _orjson_dumps_bytes(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return _ascii_dumps_bytes(obj)
+
+    def _orjson_dumps(obj: Any) -> str:
+        return _orjson_dumps_bytes(obj).decode('utf-8')
+
+    BACKENDS["orjson"] = (_orjson_loads, _orjson_dumps, _orjson_dumps_bytes)
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# loads: 解析 str 或 bytes；dumps: 序列化为 str；dumps_bytes: 序列化为 UTF-8 bytes（可直接作为响应体）
+loads, dumps, dumps_bytes = BACKENDS[BACKEND]
@@ -0,0 +1,89 @@
+# modules/log_setup.py
+# 日志模式配置：默认模式保持原有的文本日志；生产模式输出紧凑的结构化 (JSON Lines) 日志，
+# 通过队列交给后台线程写出，并对每个请求的 INFO 日志按请求采样。
+
+import contextvars
+import logging
+import logging.handlers
+import queue
+import random
+from typing import Optional
+
+from modules import json_codec
+
+# 请求路径上的 INFO 日志统一使用此 logger，并使用 %-风格参数（惰性格式化）：
+# 被采样丢弃或级别过滤的记录不会产生字符串格式化开销。
+request_logger = logging.getLogger("lmarena_bridge.request")
+
+# 当前请求是否被采样（在请求入口处决定，同一请求的日志要么全部保留要么全部丢弃）
+_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("log_sampled", default=True)
+_sample_rate = 1.0
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def sample_request() -> bool:
+    """在请求入口调用：按采样率决定该请求的 INFO 日志是否输出。"""
+    sampled = _sample_rate >= 1.0 or random.random() < _sample_rate
+    _sampled.set(sampled)
+    return sampled
+
+
+class RequestSampleFilter(logging.Filter):
+    """丢弃未被采样请求的 INFO 及以下日志；WARNING 及以上总是保留。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or _sampled.get()
+
+
+class StructuredFormatter(logging.Formatter):
+    """每条记录输出为一行紧凑 JSON。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json_codec.dumps(entry)
+
+
+def configure_logging(config: dict):
+    """
+    根据配置启用生产日志模式（需在配置加载后调用一次，修改后需重启生效）。
+    - log_mode: "default" 保持原样；"production" 启用结构化日志、异步队列和采样。
+    - log_sample_rate: 生产模式下请求 INFO 日志的采样率 (0~1)。
+    """
+    global _sample_rate, _listener
+    if config.get("log_mode", "default") != "production" or _listener is not None:
+        return
+
+    _sample_rate = max(0.0, min(1.0, float(config.get("log_sample_rate", 0.1))))
+    request_logger.addFilter(RequestSampleFilter())
+
+    # 事件循环只把记录放入队列，写出由 QueueListener 的后台线程完成
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    # uvicorn 默认直接同步写出自己的日志；改为交给根 logger 的队列
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    logging.getLogger(__name__).warning(f"已启用生产日志模式 (请求日志采样率: {_sample_rate})。")
+
+
+def shutdown_logging():
+    """停止后台写日志线程，写出队列中剩余的记录；之后的日志由根 logger 直接同步写出。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger().handlers = list(_listener.handlers)
+        _listener = None
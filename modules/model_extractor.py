@@ -0,0 +1,133 @@
+# modules/model_extractor.py
+# 从 LMArena 页面 HTML 中提取可用模型列表
+
+import json
+import logging
+import re
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Next.js 把页面数据以 flight 格式分块写在 <script>self.__next_f.push([1,"..."])</script> 中，
+# 每块的第二个元素是一个 JSON 字符串字面量。
+_FLIGHT_CHUNK_PREFIX = re.compile(r'self\.__next_f\.push\(\[1,\s*(?=")')
+# 解码后的 flight 文本中模型对象的起始位置
+_MODEL_START = re.compile(r'\{"id":"[a-f0-9-]+"')
+# 旧实现使用的、仍处于转义状态的起始位置
+_ESCAPED_MODEL_START = re.compile(r'\{\\"id\\":\\"[a-f0-9-]+\\"')
+
+_decoder = json.JSONDecoder()
+
+
+def decode_flight_payload(html_content: str) -> str:
+    """找到所有 flight 数据块，各解码一次后按顺序拼接（对象可能跨块）。"""
+    parts = []
+    for match in _FLIGHT_CHUNK_PREFIX.finditer(html_content):
+        try:
+            text, _ = _decoder.raw_decode(html_content, match.end())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(text, str):
+            parts.append(text)
+    return "".join(parts)
+
+
+def _collect_models(text: str) -> list[dict]:
+    """
+    单次前向扫描：在每个候选起点用 raw_decode (C 实现) 直接解析出完整对象。
+    解析出模型对象后跳到其末尾继续扫描，不会重复处理模型内部的嵌套对象。
+    """
+    models = []
+    model_names = set()
+    pos = 0
+    while True:
+        match = _MODEL_START.search(text, pos)
+        if not match:
+            break
+        try:
+            model_data, end = _decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            pos = match.start() + 1
+            continue
+
+        model_name = model_data.get('publicName')
+        if not model_name:
+            # 不是模型对象（可能是包含模型列表的外层对象），继续在其内部查找
+            pos = match.start() + 1
+            continue
+        # 使用publicName去重
+        if model_name not in model_names:
+            models.append(model_data)
+            model_names.add(model_name)
+        pos = end
+    return models
+
+
+def extract_models_from_html(html_content: str) -> Optional[list[dict]]:
+    """
+    从 HTML 内容中提取完整的模型JSON对象。
+    先定位并解码 Next.js flight 数据，再在解码后的文本中单次扫描提取模型；
+    页面中没有 flight 数据时回退到旧的括号匹配实现。
+    耗时与页面大小呈线性关系，但仍是 CPU 密集型操作，异步代码中应通过 asyncio.to_thread 调用。
+    """
+    flight_text = decode_flight_payload(html_content)
+    models = _collect_models(flight_text) if flight_text else []
+    if not models:
+        models = extract_models_legacy(html_content)
+
+    if models:
+        logger.info(f"成功提取并解析了 {len(models)} 个独立模型。")
+        return models
+    else:
+        logger.error("错误：在HTML响应中找不到任何匹配的完整模型JSON对象。")
+        return None
+
+
+def extract_models_legacy(html_content: str) -> list[dict]:
+    """
+    旧实现：在转义状态的 HTML 中逐个候选做括号匹配和反转义。
+    保留作为回退路径和基准测试的对照组。
+    """
+    models = []
+    model_names = set()
+
+    # 查找所有可能的模型JSON对象的起始位置
+    for start_match in _ESCAPED_MODEL_START.finditer(html_content):
+        start_index = start_match.start()
+
+        # 从起始位置开始，进行花括号匹配
+        open_braces = 0
+        end_index = -1
+
+        # 优化：设置一个合理的搜索上限，避免无限循环
+        search_limit = start_index + 10000 # 假设一个模型定义不会超过10000个字符
+
+        for i in range(start_index, min(len(html_content), search_limit)):
+            if html_content[i] == '{':
+                open_braces += 1
+            elif html_content[i] == '}':
+                open_braces -= 1
+                if open_braces == 0:
+                    end_index = i + 1
+                    break
+
+        if end_index != -1:
+            # 提取完整的、转义的JSON字符串
+            json_string_escaped = html_content[start_index:end_index]
+
+            # 反转义
+            json_string = json_string_escaped.replace('\\"', '"').replace('\\\\', '\\')
+
+            try:
+                model_data = json.loads(json_string)
+                model_name = model_data.get('publicName')
+
+                # 使用publicName去重
+                if model_name and model_name not in model_names:
+                    models.append(model_data)
+                    model_names.add(model_name)
+            except json.JSONDecodeError as e:
+                logger.warning(f"解析提取的JSON对象时出错: {e} - 内容: {json_string[:150]}...")
+                continue
+
+    return models
@@ -0,0 +1,96 @@
+# modules/persistence.py
+# 防抖的后台文件持久化：在工作线程中以“写临时文件 + 原子重命名”的方式落盘
+
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 同一文件从第一次变更起等待多久再写入（秒），窗口内的后续变更合并为一次写入
+DEFAULT_DEBOUNCE_SECONDS = 1.0
+
+
+def atomic_write(path: str, content: str):
+    """先写入同目录下的临时文件再重命名，读取方不会看到写了一半的文件。"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path) # mkstemp 创建的文件权限为 0600，保持原文件的权限
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class PersistenceService:
+    """
+    按文件路径合并写入请求。
+
+    schedule(path, render) 登记一个“生成文件内容”的函数；在 debounce 秒内对同一路径的
+    多次登记只会产生一次写入，且使用最后登记的 render。render 和写盘都在工作线程中执行，
+    因此 render 可以读取原文件、做正则替换等较慢的操作，而不会阻塞事件循环。
+    render 返回 None 表示放弃本次写入。
+    """
+
+    def __init__(self, debounce_seconds: float = DEFAULT_DEBOUNCE_SECONDS):
+        self.debounce_seconds = debounce_seconds
+        self._pending: dict[str, Callable[[], Optional[str]]] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._flush_requested: Optional[asyncio.Event] = None
+        self.writes_total = 0
+        self.coalesced_total = 0
+
+    def schedule(self, path: str, render: Callable[[], Optional[str]]):
+        """登记一次写入（必须在事件循环中调用）。"""
+        if path in self._pending:
+            self.coalesced_total += 1
+        self._pending[path] = render
+        if path not in self._tasks:
+            if self._flush_requested is None:
+                self._flush_requested = asyncio.Event()
+            self._tasks[path] = asyncio.create_task(self._run(path))
+
+    async def _run(self, path: str):
+        try:
+            while path in self._pending:
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), timeout=self.debounce_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                render = self._pending.pop(path)
+                try:
+                    await asyncio.to_thread(self._write, path, render)
+                except Exception as e:
+                    logger.error(f"❌ 写入 '{path}' 时发生错误: {e}", exc_info=True)
+        finally:
+            self._tasks.pop(path, None)
+
+    def _write(self, path: str, render: Callable[[], Optional[str]]):
+        content = render()
+        if content is None:
+            return
+        atomic_write(path, content)
+        self.writes_total += 1
+        logger.info(f"✅ '{path}' 已成功更新。")
+
+    async def flush(self):
+        """立即写入所有待写内容并等待完成（用于关闭服务器前）。"""
+        if not self._tasks:
+            return
+        self._flush_requested.set()
+        try:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+        finally:
+            self._flush_requested.clear()
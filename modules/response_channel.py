@@ -0,0 +1,141 @@
+# modules/response_channel.py
+# 每个 API 请求的有界响应通道，带高/低水位流控
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 默认高水位：单个请求最多缓冲约 1MB 的浏览器数据后要求浏览器暂停
+DEFAULT_HIGH_WATER_BYTES = 1024 * 1024
+
+# 由服务器自身中止请求时的结果（浏览器断线、缓冲溢出、重启前排空），与会话健康无关。
+# 处理器只接受这些值作为错误消息携带的 outcome，浏览器发来的错误一律按 "error" 统计。
+SERVER_ABORT_OUTCOMES = ("disconnected", "overflow", "draining")
+
+
+class ResponseChannel:
+    """
+    浏览器 -> API 客户端方向的单请求数据通道。
+
+    - 缓冲量达到高水位时，通过 on_flow_control('pause') 通知浏览器暂停读取；
+      消费方把缓冲量降到低水位以下后，通过 on_flow_control('resume') 通知恢复。
+    - 缓冲量达到硬上限（默认高水位的两倍，例如旧脚本不支持暂停指令、或消费方停止读取）时，
+      中止该请求：丢弃已缓冲的数据，放入一条错误消息并关闭通道，put() 返回 False，
+      由调用方通知浏览器取消。put() 从不等待消费方，不会阻塞同一标签页上的其他请求。
+    - 缓冲量以字符数计，对 LMArena 的流格式而言近似于字节数。
+    """
+
+    def __init__(self, request_id: str,
+                 high_water_bytes: int = DEFAULT_HIGH_WATER_BYTES,
+                 low_water_bytes: Optional[int] = None,
+                 hard_limit_bytes: Optional[int] = None,
+                 on_flow_control: Optional[Callable[[str], Awaitable[None]]] = None,
+                 model: str = "",
+                 started_at: Optional[float] = None):
+        self.request_id = request_id
+        # 请求元数据，供指标统计使用；started_at 为 API 入口处的 time.monotonic()
+        self.model = model
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.high_water_bytes = high_water_bytes
+        self.low_water_bytes = low_water_bytes if low_water_bytes is not None else high_water_bytes // 2
+        self.hard_limit_bytes = hard_limit_bytes if hard_limit_bytes is not None else high_water_bytes * 2
+        self._on_flow_control = on_flow_control
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+        self.overflowed = False
+        self.paused = False
+        self.created_at = time.time()
+        # --- 内存统计 ---
+        self.buffered_bytes = 0
+        self.peak_buffered_bytes = 0
+        self.total_bytes = 0
+        self.pause_count = 0
+
+    @staticmethod
+    def _size_of(item: Any) -> int:
+        if isinstance(item, str):
+            return len(item)
+        if isinstance(item, list):
+            return sum(len(str(part)) for part in item)
+        return 0
+
+    async def put(self, item: Any) -> bool:
+        """
+        放入一个来自浏览器的数据块，必要时触发暂停。
+        :return: 缓冲超过硬上限、请求因此被中止时返回 False（仅在中止的那一次）。
+        """
+        if self.closed:
+            return True
+        if self.buffered_bytes >= self.hard_limit_bytes:
+            self._abort()
+            return False
+        size = self._size_of(item)
+
+        self._queue.put_nowait((item, size))
+        self.buffered_bytes += size
+        self.total_bytes += size
+        if self.buffered_bytes > self.peak_buffered_bytes:
+            self.peak_buffered_bytes = self.buffered_bytes
+
+        if not self.paused and self.buffered_bytes >= self.high_water_bytes:
+            self.paused = True
+            self.pause_count += 1
+            logger.info(f"CHANNEL [ID: {self.request_id[:8]}]: 缓冲达到高水位 ({self.buffered_bytes} 字节)，通知浏览器暂停。")
+            await self._notify('pause')
+        return True
+
+    def put_nowait(self, item: Any):
+        """放入控制消息（例如断线错误），不受容量限制。"""
+        self._queue.put_nowait((item, 0))
+
+    def fail(self, message: str, outcome: str):
+        """由服务器中止请求：放入一条带结果标记的错误消息（outcome 取自 SERVER_ABORT_OUTCOMES）。"""
+        self.put_nowait({"error": message, "outcome": outcome})
+
+    async def get(self) -> Any:
+        """取出下一个数据块，缓冲量回落到低水位以下时通知浏览器恢复。"""
+        item, size = await self._queue.get()
+        self.buffered_bytes -= size
+        if self.paused and not self.closed and self.buffered_bytes <= self.low_water_bytes:
+            self.paused = False
+            logger.info(f"CHANNEL [ID: {self.request_id[:8]}]: 缓冲回落到低水位 ({self.buffered_bytes} 字节)，通知浏览器恢复。")
+            await self._notify('resume')
+        return item
+
+    def close(self):
+        """关闭通道并丢弃剩余数据。"""
+        self.closed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self.buffered_bytes = 0
+
+    def _abort(self):
+        """缓冲超过硬上限：丢弃已缓冲的数据，只留下一条错误消息给消费方。"""
+        logger.warning(f"CHANNEL [ID: {self.request_id[:8]}]: 缓冲超过硬上限 ({self.buffered_bytes} 字节)，中止该请求。")
+        self.close()
+        self.overflowed = True
+        self.paused = False # 请求已中止并在浏览器端取消，之后不再发送 resume
+        self.fail(f"Response buffer exceeded {self.hard_limit_bytes} bytes because the client stopped reading; request aborted.", "overflow")
+
+    async def _notify(self, command: str):
+        if self._on_flow_control:
+            try:
+                await self._on_flow_control(command)
+            except Exception as e:
+                logger.error(f"CHANNEL [ID: {self.request_id[:8]}]: 发送 '{command}' 流控指令失败: {e}")
+
+    def stats(self) -> dict:
+        """该请求的内存与流控统计。"""
+        return {
+            "buffered_bytes": self.buffered_bytes,
+            "peak_buffered_bytes": self.peak_buffered_bytes,
+            "total_bytes": self.total_bytes,
+            "queued_chunks": self._queue.qsize(),
+            "paused": self.paused,
+            "overflowed": self.overflowed,
+            "pause_count": self.pause_count,
+            "age_seconds": round(time.time() - self.created_at, 1),
+        }
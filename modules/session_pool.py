@@ -0,0 +1,214 @@
+# modules/session_pool.py
+# 模型映射到多个会话 ID 时，按健康状况和负载选择会话
+
+import hashlib
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_fingerprints(messages: list) -> list[str]:
+    """
+    计算对话每个前缀的指纹：第 k 项是前 k 条消息 (role, content) 序列的链式哈希。
+    多轮对话的下一轮请求以上一轮请求的全部消息为前缀，因此两者可以对应起来。
+    """
+    fingerprints = []
+    digest = b""
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+        h = hashlib.sha256(digest)
+        h.update(str(message.get("role")).encode("utf-8"))
+        h.update(b"\0")
+        h.update(content.encode("utf-8", "surrogatepass"))
+        digest = h.digest()
+        fingerprints.append(digest.hex())
+    return fingerprints
+
+
+class SessionStats:
+    """单个 session_id 的运行统计。"""
+    __slots__ = ("session_id", "in_flight", "successes", "failures", "consecutive_failures",
+                 "avg_latency", "ejected_until", "last_error")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.avg_latency = 0.0  # 成功请求耗时的指数移动平均（秒）
+        self.ejected_until = 0.0  # time.monotonic() 时间戳，在此之前不参与选择
+        self.last_error: Optional[str] = None
+
+    @property
+    def success_rate(self) -> float:
+        total = self.successes + self.failures
+        return self.successes / total if total else 1.0
+
+    def score(self) -> tuple:
+        """越小越好：优先在途请求少的，其次是按成功率惩罚后的平均耗时。"""
+        return self.in_flight, self.avg_latency / max(self.success_rate, 0.1)
+
+
+class SessionPool:
+    """
+    为 model_endpoint_map.json 中的 ID 列表选择会话。
+
+    - 采用“二选一”(power of two choices)：随机抽取两个可用会话，选择得分更优的一个，
+      既能把负载摊平，又不会让所有请求同时涌向同一个“最佳”会话。
+    - 连续失败 eject_after_failures 次的会话会被暂时剔除 eject_seconds 秒；
+      所有候选都被剔除时，选择最早恢复的那个，保证请求仍能发出。
+    - acquire()/release() 以 request_id 为键，release() 可重复调用。
+    - 会话亲和：请求成功后记住“该对话全部消息的指纹 -> 会话”；之后的请求若以某个已记住的
+      对话为前缀（即同一对话的后续轮次），优先回到上次服务它的会话（未被剔除时）。
+    """
+
+    def __init__(self):
+        self.eject_after_failures = 3
+        self.eject_seconds = 60.0
+        self.affinity_enabled = True
+        self.affinity_ttl = 1800.0
+        self.affinity_max_entries = 10000
+        self._sessions: dict[str, SessionStats] = {}
+        self._requests: dict[str, tuple[str, float, Optional[str]]] = {}  # request_id -> (session_id, 开始时间, 对话指纹)
+        self._affinity: OrderedDict[str, tuple[str, float]] = OrderedDict()  # 对话指纹 -> (session_id, 过期时间)
+        self.ejections_total = 0
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+
+    def configure(self, config: dict):
+        """从配置快照更新剔除与亲和策略（支持热重载）。"""
+        self.eject_after_failures = config.get("session_eject_after_failures", 3)
+        self.eject_seconds = config.get("session_eject_seconds", 60)
+        self.affinity_enabled = config.get("session_affinity_enabled", True)
+        self.affinity_ttl = config.get("session_affinity_ttl_seconds", 1800)
+        self.affinity_max_entries = config.get("session_affinity_max_entries", 10000)
+
+    def _stats(self, session_id: str) -> SessionStats:
+        stats = self._sessions.get(session_id)
+        if stats is None:
+            stats = self._sessions[session_id] = SessionStats(session_id)
+        return stats
+
+    def _affine_session(self, fingerprints: list[str], now: float) -> Optional[str]:
+        """按从长到短的顺序查找已记住的对话前缀（不含最后一条消息，即本轮的新输入）。"""
+        for fingerprint in reversed(fingerprints[:-1]):
+            entry = self._affinity.get(fingerprint)
+            if entry is None:
+                continue
+            session_id, expires_at = entry
+            if expires_at <= now:
+                del self._affinity[fingerprint]
+                continue
+            return session_id
+        return None
+
+    def choose(self, mappings: list[dict], fingerprints: Optional[list[str]] = None) -> dict:
+        """
+        从映射列表中选择一个条目。
+        :param fingerprints: 请求消息的前缀指纹 (prefix_fingerprints)；提供时优先选择亲和的会话。
+        """
+        if len(mappings) == 1:
+            return mappings[0]
+        now = time.monotonic()
+        available = [m for m in mappings if self._stats(m.get("session_id") or "").ejected_until <= now]
+        if self.affinity_enabled and fingerprints and len(fingerprints) > 1:
+            # 只有一条消息的请求没有可匹配的前缀，不计入命中率
+            affine_session = self._affine_session(fingerprints, now)
+            affine = next((m for m in available if affine_session and m.get("session_id") == affine_session), None)
+            if affine is not None:
+                self.affinity_hits += 1
+                return affine
+            self.affinity_misses += 1
+        if not available:
+            return min(mappings, key=lambda m: self._stats(m.get("session_id") or "").ejected_until)
+        if len(available) <= 2:
+            candidates = available
+        else:
+            candidates = random.sample(available, 2)
+        return min(candidates, key=lambda m: self._stats(m.get("session_id") or "").score())
+
+    def acquire(self, request_id: str, session_id: Optional[str], fingerprint: Optional[str] = None):
+        """
+        记录请求开始使用该会话。
+        :param fingerprint: 请求全部消息的指纹；请求成功后据此把该对话与会话关联起来。
+        """
+        if not session_id:
+            return
+        self._stats(session_id).in_flight += 1
+        self._requests[request_id] = (session_id, time.monotonic(), fingerprint)
+
+    def _remember(self, fingerprint: str, session_id: str):
+        self._affinity[fingerprint] = (session_id, time.monotonic() + self.affinity_ttl)
+        self._affinity.move_to_end(fingerprint)
+        while len(self._affinity) > self.affinity_max_entries:
+            self._affinity.popitem(last=False)
+
+    def release(self, request_id: str, outcome: str, error: Optional[str] = None):
+        """
+        记录请求结束。
+        :param outcome: 'success' 计为成功；'error'/'timeout' 计为失败；其他结果（如 cancelled、rejected、
+                        cloudflare、attachment_error、disconnected、overflow、draining）与会话本身的健康无关，只释放占用。
+        """
+        entry = self._requests.pop(request_id, None)
+        if entry is None:
+            return
+        session_id, started_at, fingerprint = entry
+        stats = self._stats(session_id)
+        stats.in_flight = max(0, stats.in_flight - 1)
+
+        if outcome == "success":
+            if fingerprint and self.affinity_enabled:
+                self._remember(fingerprint, session_id)
+            latency = time.monotonic() - started_at
+            stats.avg_latency = latency if not stats.successes else 0.8 * stats.avg_latency + 0.2 * latency
+            stats.successes += 1
+            stats.consecutive_failures = 0
+        elif outcome in ("error", "timeout"):
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            stats.last_error = error or outcome
+            if self.eject_after_failures and stats.consecutive_failures >= self.eject_after_failures:
+                stats.ejected_until = time.monotonic() + self.eject_seconds
+                stats.consecutive_failures = 0
+                self.ejections_total += 1
+                logger.warning(f"SESSION POOL: 会话 ...{session_id[-6:]} 连续失败 {self.eject_after_failures} 次，暂停使用 {self.eject_seconds} 秒。")
+
+    def affinity_stats(self) -> dict:
+        lookups = self.affinity_hits + self.affinity_misses
+        return {
+            "entries": len(self._affinity),
+            "hits": self.affinity_hits,
+            "misses": self.affinity_misses,
+            "hit_rate": round(self.affinity_hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def ejected_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for s in self._sessions.values() if s.ejected_until > now)
+
+    def snapshot(self) -> list[dict]:
+        """用于状态查询的会话概览。"""
+        now = time.monotonic()
+        return [
+            {
+                "session_id": f"...{s.session_id[-6:]}",
+                "in_flight": s.in_flight,
+                "successes": s.successes,
+                "failures": s.failures,
+                "success_rate": round(s.success_rate, 3),
+                "avg_latency_seconds": round(s.avg_latency, 3),
+                "ejected_for_seconds": max(0, round(s.ejected_until - now, 1)),
+                "last_error": s.last_error,
+            }
+            for s in self._sessions.values()
+        ]
@@ -0,0 +1,140 @@
+# modules/stream_parser.py
+# LMArena 流式响应的增量解析器
+
+import logging
+
+from modules import json_codec
+
+logger = logging.getLogger(__name__)
+
+# Cloudflare 人机验证页面的特征（小写匹配）
+CLOUDFLARE_MARKERS = ('<title>just a moment...</title>', 'enable javascript and cookies to continue')
+
+# 非协议行（例如多行的错误 JSON）最多累积的字符数，超过后丢弃
+_MAX_STRAY_CHARS = 64 * 1024
+
+
+class LMArenaStreamParser:
+    """
+    面向行的增量状态机，解析 LMArena 的流式响应。
+
+    LMArena 的响应由 "<前缀>:<JSON>\\n" 形式的行组成：
+      - a0/b0: 文本增量 (JSON 字符串)
+      - a2/b2: 图片等附加数据 (JSON 数组)
+      - ad/bd: 结束信息 (JSON 对象，包含 finishReason)
+    每个字符只被扫描一次，缓冲区只保留末尾尚未结束的半行，
+    因此总耗时与响应长度呈线性关系。
+
+    feed()/flush() 返回事件列表: ('content', str), ('finish', str),
+    ('error', str), ('cloudflare', None)。
+    """
+
+    def __init__(self):
+        self._partial: list[str] = []  # 尚未遇到换行符的半行片段
+        self._stray: list[str] = []  # 正在累积的非协议行（可能是多行错误 JSON）
+        self._stray_len = 0
+
+    def feed(self, chunk: str) -> list[tuple]:
+        """喂入一个数据块，返回其中所有完整行产生的事件。"""
+        events = []
+        if not chunk:
+            return events
+
+        pos = 0
+        newline = chunk.find('\n')
+        while newline != -1:
+            if self._partial:
+                self._partial.append(chunk[pos:newline])
+                line = "".join(self._partial)
+                self._partial = []
+            else:
+                line = chunk[pos:newline]
+            self._handle_line(line, events)
+            pos = newline + 1
+            newline = chunk.find('\n', pos)
+
+        if pos < len(chunk):
+            self._partial.append(chunk[pos:])
+        return events
+
+    def flush(self) -> list[tuple]:
+        """流结束时调用，处理最后一个没有换行符的行。"""
+        events = []
+        if self._partial:
+            line = "".join(self._partial)
+            self._partial = []
+            self._handle_line(line, events)
+        return events
+
+    def _handle_line(self, line: str, events: list):
+        if line.endswith('\r'):
+            line = line[:-1]
+        if not line:
+            return
+
+        # 协议行: [ab][0-9a-z]:<payload>
+        if len(line) > 2 and line[2] == ':' and line[0] in 'ab':
+            kind = line[1]
+            if kind == '0':
+                self._handle_text(line[3:], events)
+            elif kind == '2':
+                self._handle_image(line[3:], events)
+            elif kind == 'd':
+                self._handle_finish(line[3:], events)
+            return
+
+        self._handle_stray(line, events)
+
+    @staticmethod
+    def _handle_text(payload: str, events: list):
+        try:
+            text_content = json_codec.loads(payload)
+        except ValueError:
+            return
+        if isinstance(text_content, str) and text_content:
+            events.append(('content', text_content))
+
+    @staticmethod
+    def _handle_image(payload: str, events: list):
+        try:
+            image_data_list = json_codec.loads(payload)
+            if isinstance(image_data_list, list) and image_data_list:
+                image_info = image_data_list[0]
+                if image_info.get("type") == "image" and "image" in image_info:
+                    # 将URL包装成Markdown格式并作为内容块返回
+                    events.append(('content', f"![Image]({image_info['image']})"))
+        except (ValueError, AttributeError) as e:
+            logger.warning(f"解析图片URL时出错: {e}, 内容: {payload[:150]}")
+
+    @staticmethod
+    def _handle_finish(payload: str, events: list):
+        try:
+            finish_data = json_codec.loads(payload)
+        except ValueError:
+            return
+        if isinstance(finish_data, dict) and "finishReason" in finish_data:
+            events.append(('finish', finish_data.get("finishReason") or "stop"))
+
+    def _handle_stray(self, line: str, events: list):
+        """处理非协议行：Cloudflare 验证页面或 {"error": ...} 形式的错误（可能跨多行）。"""
+        lowered = line.lower()
+        if any(marker in lowered for marker in CLOUDFLARE_MARKERS):
+            events.append(('cloudflare', None))
+            return
+
+        # 只有以 '{' 开头的行才可能开启一个错误对象
+        if not self._stray and not line.lstrip().startswith('{'):
+            return
+        self._stray.append(line)
+        self._stray_len += len(line)
+
+        try:
+            error_json = json_codec.loads("\n".join(self._stray))
+        except ValueError:
+            if self._stray_len > _MAX_STRAY_CHARS:
+                self._stray, self._stray_len = [], 0
+            return
+
+        self._stray, self._stray_len = [], 0
+        if isinstance(error_json, dict) and "error" in error_json:
+            events.append(('error', error_json.get("error") or "来自 LMArena 的未知错误"))
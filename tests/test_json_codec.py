@@ -0,0 +1,13 @@
+# tests/test_json_codec.py
+import pytest
+
+from modules import json_codec
+
+
+@pytest.mark.parametrize("backend", sorted(json_codec.BACKENDS))
+def test_lone_surrogate_round_trip(backend):
+    loads, dumps, dumps_bytes = json_codec.BACKENDS[backend]
+    payload = loads('{"text":"\\ud800"}')
+    assert payload == {"text": "\ud800"}
+    assert loads(dumps_bytes(payload)) == payload
+    assert loads(dumps(payload)) == payload
@@ -0,0 +1,53 @@
+# tests/test_response_channel.py
+import asyncio
+
+import pytest
+
+from modules.response_channel import ResponseChannel
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_overflow_abort_is_tagged_as_overflow():
+    async def scenario():
+        channel = ResponseChannel("overflow-request", high_water_bytes=10)
+        results = [await channel.put("x" * 8) for _ in range(4)]
+        return results, await channel.get()
+
+    results, item = _run(scenario())
+    assert results == [True, True, True, False]
+    assert item["outcome"] == "overflow"
+    assert "error" in item
+
+
+@pytest.mark.parametrize("outcome", ["disconnected", "draining"])
+def test_fail_is_tagged_with_outcome(outcome):
+    async def scenario():
+        channel = ResponseChannel("failed-request")
+        await channel.put("data")
+        channel.fail("aborted by server", outcome)
+        return [await channel.get(), await channel.get()]
+
+    data, item = _run(scenario())
+    assert data == "data"
+    assert item == {"error": "aborted by server", "outcome": outcome}
+
+
+def test_no_resume_after_overflow_abort():
+    commands = []
+
+    async def on_flow_control(command):
+        commands.append(command)
+
+    async def scenario():
+        channel = ResponseChannel("paused-request", high_water_bytes=10, on_flow_control=on_flow_control)
+        while await channel.put("x" * 8):
+            pass
+        assert channel.paused is False
+        return await channel.get()
+
+    item = _run(scenario())
+    assert item["outcome"] == "overflow"
+    assert commands == ["pause"]
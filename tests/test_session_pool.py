@@ -0,0 +1,29 @@
+# tests/test_session_pool.py
+import pytest
+
+from modules.response_channel import SERVER_ABORT_OUTCOMES
+from modules.session_pool import SessionPool
+
+
+def _release_many(pool: SessionPool, outcome: str, count: int):
+    for i in range(count):
+        request_id = f"{outcome}-{i}"
+        pool.acquire(request_id, "session-a")
+        pool.release(request_id, outcome)
+
+
+def test_errors_eject_session():
+    pool = SessionPool()
+    _release_many(pool, "error", pool.eject_after_failures)
+    assert pool.ejected_count() == 1
+
+
+@pytest.mark.parametrize("outcome", ["disconnected", "overflow", "draining"])
+def test_server_abort_outcomes_do_not_eject(outcome):
+    assert outcome in SERVER_ABORT_OUTCOMES
+    pool = SessionPool()
+    _release_many(pool, outcome, pool.eject_after_failures + 2)
+    stats = pool.snapshot()[0]
+    assert pool.ejected_count() == 0
+    assert stats["failures"] == 0
+    assert stats["in_flight"] == 0